@@ -3,6 +3,7 @@ setup(
     name='tinyfpgab',
     packages=find_packages(),
     install_requires=['pyserial'],
+    extras_require={'asyncio': ['pyserial-asyncio']},
     version='1.1.0',
     description='Programmer for the TinyFPGA B2 boards (http://tinyfpga.com)',
     author='Luke Valenty',
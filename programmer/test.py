@@ -1,9 +1,38 @@
+import argparse
+import gzip
+import hashlib
+import io
+import json
 import os
 import pytest
 import shutil
+import socket
 import string
+import struct
 import tempfile
-from tinyfpgab import TinyFPGAB
+import sys
+import threading
+import time
+from tinyfpgab import FlashTiming, Telemetry, TinyFPGAB, mismatch_map
+from tinyfpgab import precise_sleep, xor_delta
+from tinyfpgab import bench, erased_ranges, group_regions, manifest
+from tinyfpgab import link
+from tinyfpgab import __main__ as cli
+from tinyfpgab import ice40
+from tinyfpgab.cache import FlashCache, load_json
+from tinyfpgab.journal import Journal
+from tinyfpgab import session
+from tinyfpgab.session import Session
+from tinyfpgab.daemon import Daemon, Server
+from tinyfpgab.daemon import request as daemon_request
+from tinyfpgab.storage import FlashDevice
+from tinyfpgab.sim import SimulatedBootloader, SimulatedFlash, VirtualClock
+from tinyfpgab import trace
+try:
+    import asyncio
+    from tinyfpgab import aio
+except (ImportError, SyntaxError):  # Python 2
+    asyncio = aio = None
 
 DATA = b'Thequickbrownfoxjumpsoverthelazydog'
 DATA_4096 = ''.join(a + b + c
@@ -20,7 +49,8 @@ class FakeSerial(object):
 
     def write(self, data):
         assert isinstance(data, bytearray)
-        self.written.append(data)
+        # copy, the programmer reuses its buffer
+        self.written.append(bytearray(data))
 
     def read(self, read_len):
         assert len(self.read_data) >= read_len
@@ -135,6 +165,75 @@ def test_read(length, serial_outs):
     serial.assert_written([bytearray.fromhex(d) for d in serial_outs])
 
 
+@pytest.mark.parametrize('window, serial_outs', [
+    (1, ['01050011000b12345600',
+         '01050011000b12346600',
+         '01050004000b12347600']),
+    (2, ['01050011000b1234560001050011000b12346600',
+         '01050004000b12347600']),
+    (8, ['01050011000b1234560001050011000b12346600'
+         '01050004000b12347600']),
+])
+def test_read_window(window, serial_outs):
+    # prepare
+    calls = []
+    serial = FakeSerial(DATA)
+    fpga = TinyFPGAB(serial, lambda *a: calls.append(a), window=window)
+    # run
+    output = fpga.read(0x123456, 35)
+    # check
+    assert output == DATA
+    assert not serial.read_data
+    serial.assert_written([bytearray.fromhex(d) for d in serial_outs])
+    assert calls == [(16,), (16,), (3,)]
+
+
+@pytest.mark.parametrize('read_size, serial_outs', [
+    (32, ['01050021000b12345600',
+          '01050004000b12347600']),
+    (35, ['01050024000b12345600']),
+    (4096, ['01050024000b12345600']),
+])
+def test_read_size(read_size, serial_outs):
+    # prepare
+    serial = FakeSerial(DATA)
+    fpga = TinyFPGAB(serial, read_size=read_size)
+    # run
+    output = fpga.read(0x123456, 35)
+    # check
+    assert output == DATA
+    assert not serial.read_data
+    serial.assert_written([bytearray.fromhex(d) for d in serial_outs])
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'read_size': 0},
+    {'read_size': 0xffff},
+    {'write_size': 0},
+    {'write_size': 257},
+])
+def test_invalid_sizes(kwargs):
+    with pytest.raises(ValueError):
+        TinyFPGAB(None, **kwargs)
+
+
+def test_cmds():
+    # prepare
+    serial = FakeSerial(bytearray.fromhex('1f840101'))
+    fpga = TinyFPGAB(serial, window=3)
+    # run
+    output = fpga.cmds([
+        (0xab, None, b'', 0),
+        (0x9f, None, b'', 3),
+        (0x05, None, b'', 1),
+    ])
+    # check
+    assert output == [b'', b'\x1f\x84\x01', b'\x01']
+    assert not serial.read_data
+    serial.assert_written([
+        bytearray.fromhex('0101000000ab01010004009f010100020005')])
+
+
 def test_wait_while_busy():
     # prepare
     serial = FakeSerial(bytearray.fromhex('0101010100'))
@@ -146,6 +245,34 @@ def test_wait_while_busy():
     serial.assert_written([bytearray.fromhex('010100020005')] * 5)
 
 
+def test_flash_timing():
+    # prepare
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    serial = FakeSerial(bytearray.fromhex('010100'))
+    timing = FlashTiming(sleep=sleep, timer=lambda: now[0])
+    fpga = TinyFPGAB(serial, timing=timing)
+    # run
+    timing.start(0x20)
+    fpga.wait_while_busy()
+    # check: waits most of the 4k erase before polling, then polls
+    assert sleeps == [pytest.approx(0.04), 0.005, 0.005]
+    assert timing.estimates[0x20] == pytest.approx(
+        0.8 * 0.05 + 0.2 * (0.045 + 0.05) / 2)
+    assert timing.opcode is None
+    # unknown operations are polled early, but never too early
+    timing.start(0x99)
+    assert timing.first_poll_delay() == FlashTiming.MIN_DELAY
+    now[0] += 0.3
+    timing.done()
+    assert timing.estimates[0x99] == pytest.approx(0.3)
+
+
 @pytest.mark.parametrize('offset, length, block_len, serial_outs', [
     # well aligned, one block
     (0x123000, 0x1000, 0x1000, ['010400000020123000']),
@@ -180,36 +307,96 @@ def test_erase(offset, length, block_len, serial_outs):
     fpga = TinyFPGAB(serial)
     fpga.write_enable = lambda: None  # patch write_enable
     fpga.wait_while_busy = lambda: None  # patch wait_while_busy
-    fpga.read = lambda *a: calls.append(('read', a)) \
-        or DATA_4096[a[0] % 4096:][:a[1]]
+    fpga._read_ranges = lambda ranges: [
+        calls.append(('read', r)) or DATA_4096[r[0] % 4096:][:r[1]]
+        for r in ranges]
     fpga.write = lambda *a: calls.append(('write', a))
     # run
     assert fpga.erase(offset, length) is None
     # check
     assert not serial.read_data
     serial.assert_written([bytearray.fromhex(d) for d in serial_outs])
-    expected_calls = []
-    restore_first_block = None
+    # all data to restore is read before erasing, and written back after
+    expected_reads = []
+    expected_writes = []
     if offset % block_len > 0:  # restore start of first block
         restore_offset = offset & ~(block_len - 1)
         restore_len = offset % block_len
-        expected_calls.append((
+        expected_reads.append((
             'read', (restore_offset, restore_len)))
-        expected_calls.append((
+        expected_writes.append((
             'write', (restore_offset, DATA_4096[:restore_len])))
-        restore_first_block = restore_offset
     if (offset + length) % block_len > 0:  # restore end of last block
         restore_offset = offset + length
         restore_len = block_len - (restore_offset % block_len)
-        read_call = ('read', (restore_offset, restore_len))
-        if restore_first_block == ((offset + length) & ~(block_len - 1)):
-            # restore before and after erase in same block
-            expected_calls.insert(1, read_call)  # 2nd read before 1st write
-        else:
-            expected_calls.append(read_call)  # 2nd read after 1st write
-        expected_calls.append((
+        expected_reads.append(('read', (restore_offset, restore_len)))
+        expected_writes.append((
             'write', (restore_offset, DATA_4096[restore_offset % block_len:])))
-    assert calls == expected_calls
+    assert calls == expected_reads + expected_writes
+
+
+def test_flash_timing_oversleep():
+    # prepare
+    now = [0.0]
+    timing = FlashTiming(sleep=lambda seconds: None, timer=lambda: now[0])
+    # run: the first status read comes 15 ms late and finds it idle
+    timing.start(0x02)
+    now[0] += 0.0157
+    timing.done(now[0])
+    # check: that says nothing about the page program time
+    assert timing.estimates[0x02] == pytest.approx(0.0007)
+    # run: idle at the first read, sooner than expected
+    timing.start(0x02)
+    now[0] += 0.0002
+    timing.done(now[0])
+    # check
+    assert timing.estimates[0x02] == pytest.approx(
+        0.8 * 0.0007 + 0.2 * 0.0002)
+
+
+def test_precise_sleep(monkeypatch):
+    # prepare
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds + 0.0005 if seconds else 0.0001
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    # run: short waits spin, yielding, rather than oversleep
+    precise_sleep(70e-6, timer=lambda: now[0])
+    # check
+    assert sleeps == [0]
+    assert now[0] == pytest.approx(0.0001)
+    # run: long waits sleep, then spin through the rest
+    del sleeps[:]
+    precise_sleep(0.05, timer=lambda: now[0])
+    # check
+    assert sleeps[0] == pytest.approx(0.048)
+    assert set(sleeps[1:]) == set([0])
+    assert 0.0501 <= now[0] < 0.0503
+
+
+@pytest.mark.parametrize('offset, length, ops, preserve, estimate', [
+    (0x30000, 0, [], [], 0),
+    (0x30000, 0x22000,
+     [(0xd8, 0x30000, 0x10000), (0xd8, 0x40000, 0x10000),
+      (0x20, 0x50000, 0x1000), (0x20, 0x51000, 0x1000)],
+     [], 0.6),
+    (0x2f010, 0x19000,
+     [(0x20, 0x2f000, 0x1000), (0xd8, 0x30000, 0x10000),
+      (0x52, 0x40000, 0x8000), (0x20, 0x48000, 0x1000)],
+     [(0x2f000, 0x10), (0x48010, 0xff0)], 0.5 + 0.0007 * 256),
+])
+def test_plan_erase(offset, length, ops, preserve, estimate):
+    # run
+    plan = TinyFPGAB(None).plan_erase(offset, length)
+    # check
+    assert plan.ops == ops
+    assert len(plan) == len(ops)
+    assert plan.preserve == preserve
+    assert plan.estimated_time == pytest.approx(estimate)
 
 
 @pytest.mark.parametrize('offset, length, serial_outs', [
@@ -239,6 +426,97 @@ def test_write(offset, length, serial_outs):
     serial.assert_written([bytearray.fromhex(d) for d in serial_outs])
 
 
+def test_write_size():
+    # prepare
+    written = []
+    fpga = TinyFPGAB(None, write_size=256)
+    fpga._write = lambda *a: written.append(a)
+    data = bytes(bytearray(range(256)) * 2)
+    # run
+    assert fpga.write(0x1234f0, data) is None
+    # check: full pages, split at the 256 bytes boundaries
+    assert written == [
+        (0x1234f0, data[:0x10]),
+        (0x123500, data[0x10:0x110]),
+        (0x123600, data[0x110:]),
+    ]
+
+
+def test_write_skips_erased():
+    # prepare
+    written = []
+    done = []
+    fpga = TinyFPGAB(None, progress=done.append)
+    fpga._write = lambda *a: written.append(a)
+    data = DATA[:16] + b'\xff' * 32 + DATA[:15] + b'\xfe'
+    # run
+    assert fpga.write(0x123400, data) is None
+    # check: only the chunks that program something, but all progress
+    assert written == [(0x123400, DATA[:16]),
+                       (0x123430, DATA[:15] + b'\xfe')]
+    assert done == [16, 16]
+
+
+def test_write_window():
+    # prepare
+    serial = FakeSerial()
+    fpga = TinyFPGAB(serial, window=2)
+    fpga.wait_while_busy = lambda: None  # patch wait_while_busy
+    # run
+    assert fpga.write(0x123400, DATA[:5]) is None
+    # check
+    serial.assert_written([
+        bytearray.fromhex('010100000006') +
+        bytearray.fromhex('0109000000021234005468657175')])
+
+
+def test_write_zero_copy():
+    # prepare
+    written = []
+    fpga = TinyFPGAB(None, write_size=256)
+    fpga._write = lambda *a: written.append(a)
+    data = bytearray(DATA * 16)
+    # run
+    assert fpga.write(0x1234f0, data) is None
+    # check: views into the image, not copies
+    assert [(addr, len(chunk)) for addr, chunk in written] == [
+        (0x1234f0, 0x10), (0x123500, 0x100), (0x123600, 0x100),
+        (0x123700, 0x20)]
+    assert b''.join(chunk.tobytes() for _, chunk in written) == data
+    # changing the image shows through the chunks
+    data[:] = b'\x00' * len(data)
+    for _, chunk in written:
+        assert isinstance(chunk, memoryview)
+        assert chunk.tobytes() == b'\x00' * len(chunk)
+
+
+class ReadintoSerial(FakeSerial):
+
+    def read(self, read_len):
+        raise AssertionError('read() used instead of readinto()')
+
+    def readinto(self, buf):
+        # a short answer, like a serial timeout
+        data = FakeSerial.read(self, min(len(buf), len(self.read_data)))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def test_read_readinto():
+    # prepare
+    serial = ReadintoSerial(DATA[:21])
+    fpga = TinyFPGAB(serial, window=2)
+    # run
+    data = fpga.read(0x123400, 32)
+    # check: filled in place, the missing bytes are left out
+    assert data == DATA[:21]
+    assert fpga.read_id() == b''
+    serial.assert_written([
+        bytearray.fromhex('0105001100') + b'\x0b\x12\x34\x00\x00' +
+        bytearray.fromhex('0105001100') + b'\x0b\x12\x34\x10\x00',
+        bytearray.fromhex('01010004009f')])
+
+
 @pytest.mark.parametrize('success', [True, False])
 def test_program(success):
     # prepare
@@ -297,6 +575,349 @@ def test_program(success):
     assert calls == expected_calls
 
 
+@pytest.mark.parametrize('changes, expected_erase, expected_write', [
+    # nothing to do
+    ({}, [], []),
+    # 1 -> 0 only, programmed in place, only the affected page
+    ({0x1234: 0x00}, [], [(0x11200, 0x100)]),
+    # needs an erase of the sector
+    ({0x1234: 0xff}, [(0x11000, 0x1000)], [(0x11000, 0x1000)]),
+    # contiguous sectors are erased and written together
+    ({0x0010: 0xff, 0x1010: 0xff, 0x4010: 0xff},
+     [(0x10000, 0x2000), (0x14000, 0x1000)],
+     [(0x10000, 0x2000), (0x14000, 0x1000)]),
+])
+def test_program_diff(changes, expected_erase, expected_write):
+    # prepare
+    calls = []
+    addr = 0x10000
+    flash = bytearray(DATA_4096.encode() * 5)
+    data = bytearray(flash)
+    for offset, value in changes.items():
+        data[offset] = value
+    data = bytes(data)
+    fpga = TinyFPGAB(None)
+
+    def erase(a, length):
+        calls.append(('erase', (a, length)))
+        flash[a - addr:a - addr + length] = b'\xff' * length
+
+    def write(a, d):
+        calls.append(('write', (a, len(d))))
+        flash[a - addr:a - addr + len(d)] = bytearray(
+            x & y for x, y in zip(flash[a - addr:], bytearray(d)))
+
+    def read(a, length):
+        reads.append((a, length))
+        return bytes(flash[a - addr:a - addr + length])
+
+    reads = []
+    fpga.read = read
+    fpga.erase = erase
+    fpga.write = write
+    # run
+    assert fpga.program(addr, data, diff=True)
+    # check: only what was written is read back again
+    assert flash == data
+    assert calls == (
+        [('erase', e) for e in expected_erase] +
+        [('write', w) for w in expected_write])
+    assert reads == [(addr, len(data))] + expected_write
+
+
+def test_flash_cache(tmpdir):
+    # prepare
+    path = str(tmpdir.join('cache', 'flash.json'))
+    cache = FlashCache('ABC', path)
+    data = (DATA_4096 * 2).encode()
+    # run & check
+    assert not cache.matches(0x30800, data)
+    cache.store(0x30800, data)
+    assert cache.matches(0x30800, data)
+    assert not cache.matches(0x30800, data[:-1])
+    assert not cache.matches(0x30000, data)
+    assert FlashCache('ABC', path).matches(0x30800, data)
+    assert not FlashCache('DEF', path).matches(0x30800, data)
+    cache.invalidate(0x31fff, 1)
+    assert not cache.matches(0x30800, data)
+    assert cache.matches(0x30800, data[:0x800])
+    assert not FlashCache('ABC', path).matches(0x30800, data)
+    cache.invalidate()
+    assert not FlashCache('ABC', path).matches(0x30800, data[:0x800])
+
+
+@pytest.mark.parametrize('text', [None, '{"boards": ', '[1, 2]'])
+def test_load_json_broken(tmpdir, text):
+    # prepare: missing, truncated or not an object
+    path = str(tmpdir.join('flash.json'))
+    if text is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    # run / check
+    assert load_json(path) == {}
+    assert not FlashCache('A', path).matches(0, DATA)
+    assert link.ProfileCache(path).get('2341:0001/ABC') is None
+    assert Journal([(0, DATA)], path).verified == set()
+
+
+def test_flash_cache_eviction(tmpdir):
+    # prepare
+    path = str(tmpdir.join('flash.json'))
+    for serial_number in ('A', 'B', 'C'):
+        FlashCache(serial_number, path, max_boards=2).store(0, DATA)
+    # check
+    assert not FlashCache('A', path).matches(0, DATA)
+    assert FlashCache('B', path).matches(0, DATA)
+    assert FlashCache('C', path).matches(0, DATA)
+    assert not FlashCache('C', path, max_age=-1).matches(0, DATA)
+
+
+def test_program_cache(tmpdir):
+    # prepare
+    calls = []
+    cache = FlashCache('ABC', str(tmpdir.join('flash.json')))
+    fpga = TinyFPGAB(None, cache=cache)
+    fpga._erase = lambda *a: calls.append(('erase', a))
+    fpga._write = lambda *a: calls.append(('write', a))
+    fpga.read = lambda *a: calls.append(('read', a)) or DATA
+    flash = {}
+    fpga._read_ranges = lambda ranges: [flash.get(r, b'\xff' * r[1])
+                                        for r in ranges]
+    # run & check
+    assert fpga.program(0x123456, DATA)
+    assert ('erase', (0x123000, 0x1000)) in calls
+    assert calls[-1] == ('read', (0x123456, 35))
+    del calls[:]
+    flash[(0x123456, 35)] = DATA
+    assert fpga.program(0x123456, DATA)
+    assert calls == []
+    # reflashed with another tool: the spot check drops the cache
+    flash[(0x123456, 35)] = DATA[::-1]
+    assert fpga.program(0x123456, DATA)
+    assert ('erase', (0x123000, 0x1000)) in calls
+    assert cache.matches(0x123456, DATA)
+
+
+def test_program_diff_cache(tmpdir):
+    # prepare: the board was reflashed with another tool after the cache
+    # learnt its contents, then one sector of the image changes
+    fpga, flash = simulated_fpga()
+    fpga.cache = FlashCache('ABC', str(tmpdir.join('flash.json')))
+    data = (DATA_4096 * 4).encode()
+    assert fpga.program(0x30000, data)
+    flash.memory[0x30000:0x34000] = b'\x00' * 0x4000
+    changed = bytearray(data)
+    changed[0x2000:0x2010] = b'\xff' * 0x10
+    changed = bytes(changed)
+    # run
+    assert fpga.program(0x30000, changed, diff=True)
+    # check
+    assert flash.memory[0x30000:0x34000] == changed
+    assert fpga.cache.matches(0x30000, changed)
+
+
+def simulated_cli(monkeypatch, tmpdir, ports, failing, options, image=None):
+    # run the CLI on an image (DATA_4096 with --force by default) with
+    # simulated boards on the ports, the failing one corrupting every page
+    # program; returns the exit status, the bootloaders, the ports booted
+    # with -b and the image file name
+    clocks = {port: VirtualClock() for port in ports}
+    bootloaders = {port: SimulatedBootloader(SimulatedFlash(
+        clock=clocks[port], seed=0,
+        program_error_rate=1.0 if port == failing else 0.0),
+        clock=clocks[port]) for port in ports}
+    booted = []
+
+    def open_sim(port):
+        bootloaders[port].is_open = True
+        return bootloaders[port]
+
+    class SimSession(Session):
+
+        def __init__(self, port, **kwargs):
+            kwargs.setdefault('opener', open_sim)
+            Session.__init__(self, port, timing=FlashTiming(
+                sleep=clocks[port].sleep, timer=clocks[port].time), **kwargs)
+
+        def boot(self):
+            booted.append(self.port)
+            Session.boot(self)
+
+    path = str(tmpdir.join('image.bin'))
+    with open(path, 'wb') as f:
+        f.write(DATA_4096.encode() if image is None else image)
+    monkeypatch.setattr('serial.tools.list_ports.comports', lambda: [
+        (port, 'TinyFPGA B', 'USB VID:PID=1209:2100') for port in ports])
+    monkeypatch.setattr(session, 'Session', SimSession)
+    monkeypatch.setattr(session, 'open_serial', open_sim)
+    monkeypatch.setattr(cli, 'time', VirtualClock())
+    monkeypatch.setattr(sys, 'argv', ['tinyfpgab', '-p', path] +
+                        (['--force'] if image is None else []) + options)
+    with pytest.raises(SystemExit) as e:
+        cli._main()
+    return e.value.code, bootloaders, booted, path
+
+
+@pytest.mark.parametrize('options, failing, code', [
+    (['-c', 'A', '-c', 'B'], None, 0),
+    (['--all', '-b'], 'B', 1),
+])
+def test_main_parallel(monkeypatch, capsys, tmpdir, options, failing, code):
+    # run
+    status, bootloaders, booted, path = simulated_cli(
+        monkeypatch, tmpdir, 'AB', failing, options)
+    # check: both boards were programmed, only the failed one is booted
+    # by -b
+    out = capsys.readouterr().out
+    assert status == code
+    for port in 'AB':
+        assert ('    {}: Programming {} with {}'.format(port, port, path)
+                in out)
+        memory = bootloaders[port].flash.memory[0x30000:0x31000]
+        assert (memory == DATA_4096.encode()) == (port != failing)
+        assert bootloaders[port].booted
+    if failing:
+        assert '1 of 2 boards programmed successfully' in out
+        assert 'Failed: B' in out
+        assert booted == ['B']
+    else:
+        assert '2 of 2 boards programmed successfully' in out
+        assert booted == []
+
+
+def test_main_files_closed(monkeypatch, tmpdir):
+    # prepare
+    trace_path = str(tmpdir.join('program.trace'))
+    events_path = str(tmpdir.join('events.json'))
+    opened = []
+
+    def recording_open(*args):
+        opened.append(open(*args))
+        return opened[-1]
+
+    monkeypatch.setattr(cli, 'open', recording_open, raising=False)
+    # run: the failed board's port stays open for booting it
+    status, _, _, _ = simulated_cli(
+        monkeypatch, tmpdir, 'A', 'A', ['--trace', trace_path, '--events',
+                                        events_path])
+    # check: both files were closed and written out completely
+    assert status == 1
+    assert len(opened) == 2 and all(f.closed for f in opened)
+    with open(trace_path, 'rb') as f:
+        records = list(trace.read_trace(f))
+    assert trace.profile(records)['busy'][0x02]
+    with open(events_path) as f:
+        events = [json.loads(line) for line in f]
+    assert events[-1]['event'] == 'phase_end'
+
+
+def test_main_events_stdout(monkeypatch, capsys, tmpdir):
+    # run
+    status, _, _, _ = simulated_cli(monkeypatch, tmpdir, 'A', None,
+                                    ['--events', '-'])
+    # check: stdout only has the events, the rest went to stderr
+    out, err = capsys.readouterr()
+    assert status == 0
+    events = [json.loads(line) for line in out.splitlines()]
+    assert events and all(event['port'] == 'A' for event in events)
+    assert 'Success!' in err
+
+
+@pytest.mark.parametrize('success', [True, False])
+def test_program_pipelined(success):
+    # prepare
+    calls = []
+    data = (DATA_4096 * 40).encode()[:0x22000]
+    fpga = TinyFPGAB(None, lambda *a: calls.append(('progress', a)))
+    # patching methods
+    fpga.erase = lambda *a: calls.append(('erase', a))
+    fpga.write = lambda a, d: calls.append(('write', (a, len(d))))
+    fpga._verify = lambda a, d: calls.append(('verify', (a, len(d)))) \
+        or success
+    # run
+    output = fpga.program(0x2f000, data, pipelined=True)
+    # check
+    assert output == success
+    expected_calls = [
+        ('progress', ('Programming block 02f000',)),
+        ('erase', (0x2f000, 0x1000)),
+        ('write', (0x2f000, 0x1000)),
+        ('verify', (0x2f000, 0x1000)),
+    ]
+    if success:
+        expected_calls.extend([
+            ('progress', ('Programming block 030000',)),
+            ('erase', (0x30000, 0x10000)),
+            ('write', (0x30000, 0x10000)),
+            ('verify', (0x30000, 0x10000)),
+            ('progress', ('Programming block 040000',)),
+            ('erase', (0x40000, 0x10000)),
+            ('write', (0x40000, 0x10000)),
+            ('verify', (0x40000, 0x10000)),
+            ('progress', ('Programming block 050000',)),
+            ('erase', (0x50000, 0x1000)),
+            ('write', (0x50000, 0x1000)),
+            ('verify', (0x50000, 0x1000)),
+            ('progress', ('Success!',)),
+        ])
+    else:
+        expected_calls.append(('progress', ('Verification Failed!',)))
+    assert calls == expected_calls
+
+
+@pytest.mark.parametrize('addr, changes, length, expected', [
+    # identical
+    (0x30000, [], 0x3000, []),
+    # one sector, adjacent bytes are merged
+    (0x30000, [0x1100, 0x1101, 0x1103], 0x3000,
+     [(0x31000, [(0x31100, 0x31102), (0x31103, 0x31104)])]),
+    # unaligned start, several sectors
+    (0x30800, [0x0, 0x900], 0x3000,
+     [(0x30000, [(0x30800, 0x30801)]), (0x31000, [(0x31100, 0x31101)])]),
+    # short read back
+    (0x30000, [], 0x2800,
+     [(0x32000, [(0x32800, 0x33000)])]),
+])
+def test_mismatch_map(addr, changes, length, expected):
+    # prepare
+    data = (DATA_4096 * 3).encode()[:0x3000]
+    read_back = bytearray(data[:length])
+    for offset in changes:
+        read_back[offset] ^= 0xff
+    # run & check
+    assert mismatch_map(addr, data, bytes(read_back)) == expected
+
+
+def test_verify_rewrite():
+    # prepare
+    calls = []
+    data = (DATA_4096 * 2).encode()[:0x1800]
+    bad = bytearray(data)
+    bad[0x810] ^= 0x01
+    bad = bytes(bad)
+    reads = [bad, bad[0x800:], data[0x800:]]
+    fpga = TinyFPGAB(None, lambda *a: calls.append(('progress', a)))
+    fpga.erase = lambda *a: calls.append(('erase', a))
+    fpga.write = lambda a, d: calls.append(('write', (a, len(d))))
+    fpga.read = lambda *a: calls.append(('read', a)) or reads.pop(0)
+    # run
+    assert fpga._verify(0x30800, data)
+    # check: only the sector holding the error is rewritten, twice
+    assert calls == [
+        ('read', (0x30800, 0x1800)),
+        ('progress', ('Need to rewrite some pages...',)),
+        ('progress', ('len: 001800 001800',)),
+        ('progress', ('rewriting page 031000',)),
+        ('erase', (0x31000, 0x1000)),
+        ('write', (0x31000, 0x1000)),
+        ('read', (0x31000, 0x1000)),
+        ('progress', ('        diff 031010-031011',)),
+        ('erase', (0x31000, 0x1000)),
+        ('write', (0x31000, 0x1000)),
+        ('read', (0x31000, 0x1000)),
+    ]
+
+
 @pytest.mark.parametrize('ext', ['hex', 'bin', 'unknown'])
 def test_slurp(bitstream_dir, ext):
     # prepare
@@ -313,6 +934,94 @@ def test_slurp(bitstream_dir, ext):
         assert output == expected
 
 
+@pytest.mark.parametrize('chunk_size', [1, 4, 7, 64 * 1024])
+def test_stream(tmpdir, chunk_size):
+    # prepare
+    data = bytes(bytearray(range(256)))
+    hex_file = tmpdir.join('bitstream.hex')
+    hex_file.write('\n'.join(
+        ' '.join('{:02x}'.format(b) for b in bytearray(data[i:i + 16]))
+        for i in range(0, 256, 16)))
+    bin_file = tmpdir.join('bitstream.bin')
+    bin_file.write_binary(data)
+    fpga = TinyFPGAB(None)
+    expected = [data[i:i + chunk_size] for i in range(0, 256, chunk_size)]
+    # run & check
+    assert list(fpga.stream(str(hex_file), chunk_size)) == expected
+    assert list(fpga.stream(str(bin_file), chunk_size)) == expected
+
+
+@pytest.mark.parametrize('name', ['bitstream.bin.gz', 'bitstream.hex.gz'])
+def test_stream_gzip(tmpdir, name):
+    # prepare
+    data = bytes(bytearray(range(256)))
+    with gzip.open(str(tmpdir.join(name)), 'wb') as f:
+        if '.hex' in name:
+            f.write(' '.join('{:02x}'.format(b)
+                             for b in bytearray(data)).encode('ascii'))
+        else:
+            f.write(data)
+    # run & check
+    assert list(TinyFPGAB(None).stream(str(tmpdir.join(name)), 100)) == [
+        data[:100], data[100:200], data[200:]]
+
+
+def test_xor_delta():
+    # prepare
+    base = [DATA[:10], DATA[10:20]]
+    new = [DATA[:3] + b'x', DATA[4:25] + b'\x00' * 4]
+    # run
+    delta = list(xor_delta(base, new))
+    # check: same chunking, base is 0xff past its end
+    assert [len(chunk) for chunk in delta] == [4, 25]
+    assert delta[0] == b'\x00\x00\x00\x09'  # 'q' ^ 'x'
+    assert delta[1][-4:] == b'\xff' * 4
+    assert b''.join(xor_delta(base, delta)) == b''.join(new)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_stream_delta(tmpdir, compress):
+    # prepare
+    base = (DATA_4096 * 2).encode()
+    new = bytearray(base + DATA)
+    new[0x1234] ^= 0x40
+    tmpdir.join('base.bin').write_binary(base)
+    delta = b''.join(xor_delta([base], [bytes(new)]))
+    name = str(tmpdir.join('new.delta' + ('.gz' if compress else '')))
+    with (gzip.open if compress else open)(name, 'wb') as f:
+        f.write(delta)
+    fpga = TinyFPGAB(None)
+    # run & check
+    assert fpga.slurp(name, str(tmpdir.join('base.bin'))) == (
+        0x30000, bytes(new))
+    with pytest.raises(ValueError):
+        fpga.slurp(name)
+
+
+def test_stream_short_tokens(tmpdir):
+    # prepare
+    hex_file = tmpdir.join('bitstream.hex')
+    hex_file.write('0 ff 1\n80')
+    # run & check
+    assert list(TinyFPGAB(None).stream(str(hex_file))) == [b'\x00\xff\x01\x80']
+
+
+@pytest.mark.parametrize('success', [True, False])
+def test_program_stream(success):
+    # prepare
+    calls = []
+    fpga = TinyFPGAB(None)
+    fpga.program = lambda *a: calls.append(a) or success
+    # run
+    output = fpga.program_stream(0x30000, iter([DATA[:16], DATA[16:]]))
+    # check
+    assert output == success
+    if success:
+        assert calls == [(0x30000, DATA[:16]), (0x30010, DATA[16:])]
+    else:
+        assert calls == [(0x30000, DATA[:16])]
+
+
 @pytest.mark.parametrize('success', [True, False])
 def test_program_bitstream(success):
     # prepare
@@ -334,8 +1043,921 @@ def test_program_bitstream(success):
     expected_calls = [
         ('progress', ('Waking up SPI flash', )),
         ('progress', ('35 bytes to program', )),
-        ('program', (0x123456, DATA)),
+        ('program', (0x123456, DATA, False, False)),
     ]
     if success:
         expected_calls.append(('boot', ()))
     assert calls == expected_calls
+
+
+def simulated_fpga(window=1, latency=0.001, **kwargs):
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock, seed=0, **kwargs)
+    bootloader = SimulatedBootloader(flash, latency=latency, clock=clock)
+    timing = FlashTiming(sleep=clock.sleep, timer=clock.time)
+    return TinyFPGAB(bootloader, window=window, timing=timing), flash
+
+
+@pytest.mark.parametrize('regions, expected', [
+    # sorted, empty regions dropped
+    ([(0x40000, b'b'), (0x30000, b'a'), (0x50000, b'')],
+     [[(0x30000, b'a')], [(0x40000, b'b')]]),
+    # regions sharing a sector are grouped
+    ([(0x30000, b'a' * 0x1001), (0x31800, b'b'), (0x32000, b'c')],
+     [[(0x30000, b'a' * 0x1001), (0x31800, b'b')], [(0x32000, b'c')]]),
+])
+def test_group_regions(regions, expected):
+    assert group_regions(regions) == expected
+
+
+def test_group_regions_overlap():
+    with pytest.raises(ValueError):
+        group_regions([(0x30000, b'ab'), (0x30001, b'c')])
+
+
+def test_manifest(tmpdir):
+    # prepare
+    tmpdir.join('top.bin').write_binary(DATA)
+    tmpdir.join('data').mkdir().join('user.bin').write_binary(b'\x01' * 16)
+    path = tmpdir.join('flash.json')
+    path.write(json.dumps({'regions': [
+        {'file': 'data/user.bin', 'addr': '0x50000'},
+        {'file': 'top.bin'},
+    ]}))
+    # run
+    regions = manifest.load(str(path))
+    # check
+    assert regions == [('top.bin', 0x30000, DATA),
+                       ('data/user.bin', 0x50000, b'\x01' * 16)]
+
+
+@pytest.mark.parametrize('entries, message', [
+    ([], 'No regions'),
+    ([{'addr': 0}], 'without a file'),
+    ([{'file': 'top.bin', 'addr': 'x'}], 'Invalid addr'),
+    ([{'file': 'top.bin', 'addr': -1}], 'Negative'),
+    ([{'file': 'top.bin', 'addr': 0x7fff0}], 'ends past'),
+    ([{'file': 'top.bin', 'addr': 0x30000},
+      {'file': 'top.bin', 'addr': 0x30010}], 'overlaps'),
+])
+def test_manifest_invalid(tmpdir, entries, message):
+    # prepare
+    tmpdir.join('top.bin').write_binary(DATA)
+    path = tmpdir.join('flash.json')
+    path.write(json.dumps(entries))
+    # run & check
+    with pytest.raises(ValueError) as e:
+        manifest.load(str(path))
+    assert message in str(e.value)
+
+
+def test_program_regions():
+    # prepare
+    calls = []
+    fpga = TinyFPGAB(None, lambda *a: calls.append(('progress', a)))
+    fpga.erase = lambda *a: calls.append(('erase', a))
+    fpga.write = lambda a, d: calls.append(('write', (a, len(d))))
+    fpga._verify = lambda a, d: calls.append(('verify', (a, len(d)))) or True
+    # run
+    assert fpga.program_regions([(0x50000, DATA), (0x30000, DATA)])
+    # check: one erase, write and verify pass over all regions
+    assert calls == [
+        ('progress', ('Erasing designated flash pages',)),
+        ('erase', (0x30000, 35)),
+        ('erase', (0x50000, 35)),
+        ('progress', ('Writing bitstream',)),
+        ('write', (0x30000, 35)),
+        ('write', (0x50000, 35)),
+        ('progress', ('Verifying bitstream',)),
+        ('verify', (0x30000, 35)),
+        ('verify', (0x50000, 35)),
+        ('progress', ('Success!',)),
+    ]
+
+
+def test_simulated_flash():
+    # prepare
+    fpga, flash = simulated_fpga()
+    # run & check
+    assert fpga.read_id() == b'\x1f\x84\x01'
+    assert fpga.read(0x1000, 4) == b'\xff' * 4
+    # page program without write enable is ignored
+    fpga.cmd(0x02, 0x1000, b'\x0f\xf0')
+    assert fpga.read(0x1000, 2) == b'\xff\xff'
+    # programming only clears bits
+    fpga._write(0x1000, b'\x0f\xf0')
+    fpga._write(0x1000, b'\xf1\x1f')
+    assert fpga.read(0x1000, 2) == b'\x01\x10'
+    # commands are ignored while busy
+    fpga.write_enable()
+    fpga.cmd(0x20, 0x1000)
+    assert ord(fpga.read_sts()) & 1
+    assert fpga.read(0x1000, 2) == b'\xff\xff'
+    fpga.wait_while_busy()
+    assert fpga.read(0x1000, 2) == b'\xff\xff'
+    assert flash.stats[0x20] == 1
+    # deep power-down
+    fpga.sleep()
+    assert fpga.read_id() == b'\xff\xff\xff'
+    fpga.wake()
+    assert fpga.read_id() == b'\x1f\x84\x01'
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_simulated_program(window):
+    # prepare
+    fpga, flash = simulated_fpga(window)
+    flash.memory[:] = bytearray(range(256)) * (len(flash.memory) // 256)
+    before = bytes(flash.memory)
+    data = (DATA_4096 * 3).encode()
+    addr = 0x2f010
+    # run
+    assert fpga.is_bootloader_active()
+    assert fpga.program(addr, data)
+    # check: data written, everything around it preserved
+    assert flash.memory[addr:addr + len(data)] == data
+    assert flash.memory[:addr] == before[:addr]
+    assert flash.memory[addr + len(data):] == before[addr + len(data):]
+
+
+@pytest.mark.parametrize('diff, pipelined', [
+    (False, False), (True, False), (False, True)])
+def test_simulated_program_regions(diff, pipelined):
+    # prepare: the regions share a sector with data between them
+    fpga, flash = simulated_fpga()
+    flash.memory[0x30000:0x31000] = b'\x5a' * 0x1000
+    # run
+    assert fpga.program_regions([(0x30800, DATA), (0x30100, DATA)],
+                                diff=diff, pipelined=pipelined)
+    # check
+    assert flash.memory[0x30000:0x30100] == b'\x5a' * 0x100
+    assert flash.memory[0x30100:0x30123] == DATA
+    assert flash.memory[0x30123:0x30800] == b'\x5a' * 0x6dd
+    assert flash.memory[0x30800:0x30823] == DATA
+    assert flash.memory[0x30823:0x31000] == b'\x5a' * 0x7dd
+    assert flash.stats[0x20] == 1
+
+
+def test_simulated_detection():
+    # prepare: the first wake is lost while the flash is powered down
+    fpga, flash = simulated_fpga()
+    flash.powered_down = True
+    # run
+    assert fpga.is_bootloader_active()
+    # check: done after one round, without sleeping
+    assert fpga.timing.timer() < 0.05
+    assert flash.stats[0x9f] == 1
+
+
+def test_session():
+    # prepare
+    opened = []
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock)
+
+    def opener(port):
+        opened.append(port)
+        return SimulatedBootloader(flash, clock=clock)
+
+    session = Session('COM3', opener, window=4, timing=FlashTiming(
+        sleep=clock.sleep, timer=clock.time))
+    # run & check: one port and one detection for several steps
+    assert session.detect()
+    assert session.detect()
+    assert session.fpga.window == 4
+    assert session.fpga.program(0x30000, DATA)
+    assert flash.stats[0x9f] == 1
+    # a reset reopens the port and detects again
+    session.reset()
+    assert session.detect()
+    assert flash.stats[0x9f] == 2
+    ser = session.ser
+    session.boot()
+    assert ser.booted and not ser.is_open
+    assert session.ser is None
+    assert opened == ['COM3', 'COM3']
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def async_simulated_fpga(window=1, **kwargs):
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock, seed=0)
+    streams = aio.SimulatedStreams(SimulatedBootloader(flash, clock=clock))
+    timing = FlashTiming(sleep=clock.sleep, timer=clock.time)
+    fpga = aio.AsyncTinyFPGAB(
+        streams.reader, streams, window=window, timing=timing,
+        delay=lambda seconds: clock.sleep(seconds) or asyncio.sleep(0),
+        **kwargs)
+    return fpga, flash
+
+
+@pytest.mark.skipif(aio is None, reason='asyncio needs Python 3')
+@pytest.mark.parametrize('window', [1, 16])
+def test_async_program(loop, window):
+    # prepare: several boards on one event loop
+    data = (DATA_4096 * 2).encode()[:0x1234]
+    boards = [async_simulated_fpga(window) for _ in range(3)]
+    # run
+    results = loop.run_until_complete(asyncio.gather(*[
+        fpga.program_bitstream(0x30010 + i, data)
+        for i, (fpga, _) in enumerate(boards)]))
+    # check
+    assert results == [True, True, True]
+    for i, (fpga, flash) in enumerate(boards):
+        assert flash.memory[0x30010 + i:0x31244 + i] == data
+        assert flash.memory[0x30000:0x30010 + i] == b'\xff' * (0x10 + i)
+        assert fpga.writer.bootloader.booted
+
+
+@pytest.mark.skipif(aio is None, reason='asyncio needs Python 3')
+def test_async_program_diff(loop):
+    # prepare: one sector needs an erase, one page is programmed in place
+    data = bytearray((DATA_4096 * 3).encode())
+    fpga, flash = async_simulated_fpga(window=16)
+    flash.memory[0x30000:0x33000] = data
+    flash.memory[0x31234] = 0x00
+    data[0x2345] = 0x00
+    data = bytes(data)
+    reads = []
+    read = fpga.read
+
+    def record(addr, length):
+        reads.append((addr, length))
+        return read(addr, length)
+
+    fpga.read = record
+    # run
+    assert loop.run_until_complete(fpga.program_bitstream(
+        0x30000, data, diff=True))
+    # check: only what was written is read back again
+    assert flash.memory[0x30000:0x33000] == data
+    assert reads == [(0x30000, 0x3000), (0x31000, 0x1000), (0x32300, 0x100)]
+
+
+@pytest.mark.skipif(aio is None, reason='asyncio needs Python 3')
+def test_async_timeout(loop):
+    # prepare
+    written = []
+
+    class Writer(object):
+        def write(self, data):
+            written.append(data)
+
+        def drain(self):
+            return asyncio.sleep(0)
+
+    reader = asyncio.StreamReader()
+    fpga = aio.AsyncTinyFPGAB(reader, Writer(), timeout=0.01)
+    # run & check
+    with pytest.raises(asyncio.TimeoutError):
+        loop.run_until_complete(fpga.read_id())
+    # the late answer is skipped by the next transfer
+    reader.feed_data(b'\x1f\x84\x01\x1f\x84\x02')
+    assert loop.run_until_complete(fpga.read_id()) == b'\x1f\x84\x02'
+    assert written == [bytes(bytearray.fromhex('01010004009f'))] * 2
+
+
+@pytest.mark.parametrize('granularity, expected', [
+    (0x1000, [(0x2f800, 0x30000), (0x31000, 0x33000)]),
+    (0x100, [(0x2f800, 0x30000), (0x30100, 0x30800), (0x30900, 0x33000)]),
+])
+def test_erased_ranges(granularity, expected):
+    # prepare
+    data = bytearray(b'\xff' * 0x3800)
+    data[0x800] = 0
+    data[0x10ff] = 0xfe
+    # run & check
+    assert erased_ranges(0x2f800, bytes(data), granularity) == expected
+
+
+def test_simulated_dump():
+    # prepare
+    fpga, flash = simulated_fpga()
+    flash.memory[0x30000:0x30023] = DATA
+    # run
+    chunks = list(fpga.dump(0x2ff00, 0x2100, chunk_size=0x1000))
+    # check: aligned chunks
+    assert [(addr, len(chunk)) for addr, chunk in chunks] == [
+        (0x2ff00, 0x100), (0x30000, 0x1000), (0x31000, 0x1000)]
+    assert b''.join(bytes(chunk) for _, chunk in chunks) == bytes(
+        flash.memory[0x2ff00:0x32000])
+
+
+def test_main_dump_checksum(tmpdir):
+    # prepare
+    fpga, flash = simulated_fpga()
+    flash.memory[0x30000:0x30023] = DATA
+    path = str(tmpdir.join('flash.sha256'))
+    args = argparse.Namespace(dump=path, checksum=True, sparse=False)
+    # run
+    digest = cli._dump(fpga, 0x2ff00, 0x1200, args, None)
+    # check: one line per (partial) sector, then the whole range
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert digest == hashlib.sha256(flash.memory[0x2ff00:0x31100]).hexdigest()
+    assert lines == [
+        '02ff00 ' + hashlib.sha256(b'\xff' * 0x100).hexdigest(),
+        '030000 ' + hashlib.sha256(flash.memory[0x30000:0x31000]).hexdigest(),
+        '031000 ' + hashlib.sha256(b'\xff' * 0x100).hexdigest(),
+        '02ff00-031100 ' + digest]
+
+
+def test_main_dump_sparse(tmpdir):
+    # prepare: a part across the 64k dump chunks and a small one
+    fpga, flash = simulated_fpga(window=16)
+    flash.memory[0x3f000:0x41000] = (DATA_4096 * 2).encode()
+    flash.memory[0x48010:0x48033] = DATA
+    path = str(tmpdir.join('flash.json'))
+    args = argparse.Namespace(dump=path, checksum=False, sparse=True)
+    # run
+    cli._dump(fpga, 0x30000, 0x20000, args, None)
+    # check: the manifest programs the same contents back
+    with open(path) as f:
+        assert json.load(f) == {'regions': [
+            {'file': 'flash-03f000.bin', 'addr': '0x03f000'},
+            {'file': 'flash-048000.bin', 'addr': '0x048000'}]}
+    assert manifest.load(path) == [
+        ('flash-03f000.bin', 0x3f000, bytes(flash.memory[0x3f000:0x41000])),
+        ('flash-048000.bin', 0x48000, bytes(flash.memory[0x48000:0x49000]))]
+
+
+def test_dump_short_read():
+    # prepare
+    fpga = TinyFPGAB(None)
+    fpga.read = lambda addr, length: DATA[:length - 1]
+    # run & check
+    with pytest.raises(IOError):
+        list(fpga.dump(0x30000, 16))
+
+
+def test_simulated_program_erased_pages():
+    # prepare
+    fpga, flash = simulated_fpga()
+    fpga.write_size = 256
+    data = b'\x00' * 0x100 + b'\xff' * 0xe00 + b'\x00' * 0x100
+    flash.memory[0x30000:0x31000] = b'\x00' * 0x1000
+    # run
+    assert fpga.program(0x30000, data)
+    # check
+    assert flash.memory[0x30000:0x31000] == data
+    assert flash.stats[0x02] == 2
+
+
+def test_journal(tmpdir):
+    # prepare
+    path = str(tmpdir.join('journal.json'))
+    regions = [(0x30800, b'a' * 0x2000), (0x40000, b'b' * 0x10)]
+    journal = Journal(regions, path)
+    # run
+    journal.record(0x30800, 0x1800)
+    # check: saved, and only for the same image
+    assert Journal(regions, path).remaining(regions) == [
+        (0x32000, b'a' * 0x800), (0x40000, b'b' * 0x10)]
+    assert Journal([(0x30800, b'c' * 0x2000)], path).verified == set()
+    assert Journal(regions, path, max_age=-1).verified == set()
+    journal.finish()
+    assert not tmpdir.join('journal.json').check()
+
+
+def test_journal_verify():
+    # prepare: one sector never reads back right
+    data = (DATA_4096 * 4).encode()
+    regions = [(0x30000, data)]
+    fpga = TinyFPGAB(None, journal=Journal(regions),
+                     timing=FlashTiming(sleep=lambda seconds: None))
+
+    def read(a, length):
+        read_back = bytearray(data[a - 0x30000:a - 0x30000 + length])
+        if a <= 0x31000 < a + length:
+            read_back[0x31000 - a] ^= 1
+        return bytes(read_back)
+
+    fpga.erase = fpga.write = lambda *a: None
+    fpga.read = read
+    # run
+    assert not fpga._verify(0x30000, data)
+    # check: the other sectors are recorded as verified
+    assert fpga.journal.remaining(regions) == [
+        (0x31000, data[0x1000:0x2000])]
+
+
+class FlakySerial(object):
+    # a serial port that fails after `frames` transfers, like a board
+    # dropping off the bus
+    def __init__(self, ser, frames):
+        self.ser = ser
+        self.frames = frames
+
+    def write(self, data):
+        if self.frames <= 0:
+            raise IOError('device disconnected')
+        self.frames -= 1
+        return self.ser.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+def test_simulated_resume():
+    # prepare
+    fpga, flash = simulated_fpga(window=16)
+    fpga.journal = Journal([])
+    data = (DATA_4096 * 50).encode()[:0x30000]
+    bootloader = fpga.ser
+    fpga.ser = FlakySerial(bootloader, 10000)
+    # run: the port drops in the second block, then the run is retried
+    with pytest.raises(IOError):
+        fpga.program(0x30000, data, pipelined=True)
+    erases = flash.stats[0xd8]
+    fpga.ser = bootloader
+    assert fpga.program(0x30000, data, pipelined=True)
+    # check: the first block was not programmed again
+    assert erases == 2
+    assert flash.stats[0xd8] == 4
+    assert flash.memory[0x30000:0x60000] == data
+    assert fpga.journal.verified == set()
+
+
+@pytest.mark.parametrize('device, max_transfer, expected', [
+    # the stock native bootloader: only frames of 16 bytes, so only the
+    # window is tuned
+    ('1209:2100', 16, (115200, 16, 16, 8)),
+    # programmer.ino, only answering at 115200 baud
+    ('2341:0001', 128, (115200, 127, 64, 4)),
+])
+def test_link_calibrate(device, max_transfer, expected):
+    # prepare
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock, seed=0)
+    flash.memory[:len(DATA)] = DATA
+    opened = []
+    bootloaders = []
+
+    def opener(port, baudrate, timeout):
+        opened.append(baudrate)
+        bootloader = SimulatedBootloader(flash, latency=0.001, clock=clock,
+                                         max_transfer=max_transfer)
+        bootloaders.append(bootloader)
+        # a UART at the wrong baud rate gets no answer
+        bootloader.booted = baudrate != 115200
+        return bootloader
+
+    # run
+    profile = link.calibrate('/dev/ttyACM0', link.transport(device), opener,
+                             timer=clock.time, sleep=clock.sleep)
+    # check
+    assert (profile.baudrate, profile.read_size, profile.write_size,
+            profile.window) == expected
+    assert opened == list(link.transport(device).bauds)
+    assert profile.timeout >= 0.2
+    if device == '1209:2100':
+        # nothing larger than the stock bootloader takes was sent
+        assert not any(b.stats['dropped'] for b in bootloaders)
+
+
+def test_link_calibrate_no_bootloader():
+    # prepare
+    clock = VirtualClock()
+    bootloader = SimulatedBootloader(latency=0.001, clock=clock)
+    bootloader.booted = True
+    # run
+    profile = link.calibrate('/dev/ttyACM0', link.NATIVE,
+                             lambda port, **kwargs: bootloader,
+                             timer=clock.time, sleep=clock.sleep)
+    # check
+    assert profile is None
+    assert not bootloader.is_open
+
+
+def test_link_profile_cache(tmpdir):
+    # prepare
+    path = str(tmpdir.join('links.json'))
+    profile = link.LinkProfile('uart', 115200, 0.2, 127, 64, 4)
+    # run
+    link.ProfileCache(path).put('2341:0001/ABC', profile)
+    # check
+    assert link.ProfileCache(path).get('2341:0001/ABC') == profile
+    assert link.ProfileCache(path).get('2341:0001/DEF') is None
+    assert link.ProfileCache(path, max_age=-1).get('2341:0001/ABC') is None
+    link.ProfileCache(path).forget('2341:0001/ABC')
+    assert link.ProfileCache(path).get('2341:0001/ABC') is None
+
+
+def test_flash_device():
+    # prepare
+    fpga, flash = simulated_fpga()
+    text = DATA_4096.encode('ascii')
+    flash.memory[0x50000:0x52000] = text * 2
+    device = FlashDevice(fpga)
+    # run: reads and writes across a sector boundary
+    device.seek(0x50ffe)
+    assert device.read(4) == text[-2:] + text[:2]
+    device.seek(-4, io.SEEK_CUR)
+    # only clears bits of the first sector, sets bits in the second
+    assert device.write(b'\x00\x00\xff\xff') == 4
+    assert device.tell() == 0x51002
+    device.seek(0x50ffe)
+    assert device.read(4) == b'\x00\x00\xff\xff'
+    # check: nothing programmed before the flush
+    assert flash.memory[0x50ffe:0x51002] == text[-2:] + text[:2]
+    device.flush()
+    assert flash.memory[0x50000:0x52000] == \
+        text[:-2] + b'\x00\x00\xff\xff' + text[2:]
+    assert flash.stats[0x20] == 1
+    assert not device.dirty
+
+
+def test_flash_device_protect():
+    # prepare
+    fpga, flash = simulated_fpga()
+    device = FlashDevice(fpga)
+    # run & check
+    device.seek(0x2ffff)
+    with pytest.raises(IOError):
+        device.write(b'ab')
+    device.seek(0x7ffff)
+    with pytest.raises(IOError):
+        device.write(b'ab')
+    assert device.read(2) == b'\xff'
+    assert device.read(2) == b''
+
+
+def test_flash_device_eviction():
+    # prepare
+    fpga, flash = simulated_fpga()
+    device = FlashDevice(fpga, cache_size=2)
+    # run: whole sectors, nothing needs to be read
+    device.seek(0x40000)
+    device.write(b'a' * 0x1000 + b'b' * 0x1000)
+    reads = flash.stats[0x0b]
+    device.write(b'c' * 0x1000)
+    # check: the least recently used sector was programmed to make room
+    assert flash.memory[0x40000:0x41000] == b'a' * 0x1000
+    assert flash.memory[0x41000:0x43000] == b'\xff' * 0x2000
+    assert sorted(device.dirty) == [0x41000, 0x42000]
+    device.close()
+    assert flash.memory[0x41000:0x43000] == b'b' * 0x1000 + b'c' * 0x1000
+    # one 4k erase for the first sector, one for the last two together
+    assert flash.stats[0x20] == 3
+    assert flash.stats[0x0b] > reads
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='needs Unix sockets')
+def test_daemon(tmpdir):
+    # prepare
+    clock = VirtualClock()
+    bootloader = SimulatedBootloader(clock=clock)
+    timing = FlashTiming(sleep=clock.sleep, timer=clock.time)
+    ports = []
+    daemon = Daemon(lambda: list(ports), lambda port: Session(
+        port, opener=lambda port: bootloader, timing=timing), 0.01)
+    path = str(tmpdir.join('tinyfpgab.sock'))
+    server = Server(path, daemon)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    filename = str(tmpdir.join('bitstream.bin'))
+    with open(filename, 'wb') as f:
+        f.write(DATA)
+    results = []
+    progress = []
+    job = threading.Thread(target=lambda: results.append(daemon_request(
+        {'op': 'program', 'file': filename, 'addr': 0x30000, 'wait': 10},
+        path, progress.append)))
+    try:
+        assert daemon_request({'op': 'boot'}, path) == {
+            'ok': False, 'error': 'No active bootloader'}
+        # run: the job is queued before the board appears
+        job.start()
+        ports.append('/dev/ttyACM0')
+        job.join()
+        listed = daemon_request({'op': 'list'}, path)
+    finally:
+        server.shutdown()
+        thread.join()
+    # check
+    assert results == [{'ok': True, 'port': '/dev/ttyACM0'}]
+    assert {'port': '/dev/ttyACM0', 'progress': 'Success!'} in progress
+    assert bootloader.flash.memory[0x30000:0x30023] == DATA
+    assert bootloader.booted
+    assert listed == {'ok': True, 'boards': [], 'busy': []}
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('job', [
+    # past the end, where it would wrap around to the bootloader
+    {'op': 'program', 'addr': 0x7f000},
+    # over the bootloader
+    {'op': 'program', 'addr': 0x2f000},
+    {'op': 'dump', 'addr': 0x7f000, 'length': 0x2000},
+])
+def test_daemon_range(tmpdir, job):
+    # prepare
+    filename = str(tmpdir.join('image.bin'))
+    with open(filename, 'wb') as f:
+        f.write((DATA_4096 * 2).encode())
+    job['file'] = filename
+    daemon = Daemon(lambda: [], None)
+    # run / check: rejected before waiting for a board
+    with pytest.raises(ValueError, match='outside of the flash'):
+        daemon.run(job, lambda message: None)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='needs Unix sockets')
+def test_server_socket(tmpdir):
+    # prepare: a socket left behind by a service that crashed
+    path = str(tmpdir.join('tinyfpgab.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    # run / check: it is replaced, but not the socket of a running service
+    server = Server(path, Daemon(lambda: [], None))
+    try:
+        with pytest.raises(IOError, match='already running'):
+            Server(path, Daemon(lambda: [], None))
+        assert os.path.exists(path)
+    finally:
+        server.server_close()
+
+
+def test_daemon_retry():
+    # prepare: the port can't be opened at first, like during a udev
+    # permission race
+    clock = VirtualClock()
+    bootloader = SimulatedBootloader(clock=clock)
+    timing = FlashTiming(sleep=clock.sleep, timer=clock.time)
+    opened = []
+
+    def opener(port):
+        opened.append(port)
+        if len(opened) == 1:
+            raise IOError('Permission denied')
+        return bootloader
+
+    daemon = Daemon(lambda: ['/dev/ttyACM0'], lambda port: Session(
+        port, opener=opener, timing=timing), retry_interval=0.05)
+    # run / check: probed again once the backoff is over
+    daemon.scan_once()
+    daemon.scan_once()
+    assert daemon.sessions == {} and len(opened) == 1
+    time.sleep(0.06)
+    daemon.scan_once()
+    assert list(daemon.sessions) == ['/dev/ttyACM0']
+    assert daemon.run({'op': 'boot', 'wait': 1}, lambda message: None) == {
+        'ok': True, 'port': '/dev/ttyACM0'}
+    assert bootloader.booted
+
+
+def ice40_bitstream(width=872, height=272, comment=b'iCE40LP8K-CM81',
+                    padding=b'\x00' * 100, crc=None):
+    # the commands icepack writes: frequency range, CRC reset, then the
+    # size, offset and data of every bank, the CRC check and the wakeup
+    data = b'\x51\x00\x01\x05'
+    for bank in range(4):
+        data += struct.pack('>BHBHBHBB', 0x62, width - 1, 0x72, height, 0x82,
+                            0, 0x11, bank)
+        data += b'\x01\x01' + bytes(bytearray(
+            (bank + i) & 0xff for i in range(width * height // 8)))
+        data += b'\x00\x00'
+    data += b'\x22'
+    if crc is None:
+        crc = ice40._crc16(0xffff, data[4:])
+    data += struct.pack('>H', crc) + b'\x01\x06'
+    return (b'\xff\x00Lattice\x00' + comment + b'\x00\x00\xff' +
+            ice40.SYNC + data + padding)
+
+
+def test_ice40_analyze():
+    # prepare
+    data = ice40_bitstream()
+    # run
+    bitstream = ice40.analyze(data)
+    # check
+    assert ice40._crc16(0xffff, b'123456789') == 0x29b1
+    assert bitstream == ice40.Bitstream(
+        '8k', 'iCE40LP8K', ['Lattice', 'iCE40LP8K-CM81'], 1, len(data) - 100)
+    assert ice40.analyze(ice40.SYNC + b'\x01\x08').end is None
+    assert ice40.analyze(DATA) is None
+
+
+@pytest.mark.parametrize('kwargs, message', [
+    ({'width': 332, 'height': 144, 'comment': b''}, 'iCE40 1k die'),
+    ({'comment': b'iCE40UP5K-SG48'}, 'iCE40UP5K'),
+    ({'crc': 0x1234}, 'CRC error'),
+])
+def test_ice40_check_invalid(kwargs, message):
+    with pytest.raises(ValueError) as e:
+        ice40.check(ice40_bitstream(**kwargs))
+    assert message in str(e.value)
+
+
+def test_ice40_check():
+    # prepare
+    data = ice40_bitstream(padding=b'\x00\xff' * 50)
+    # run & check: padding trimmed, data or truncated bitstreams not
+    assert ice40.check(data) == data[:-100]
+    assert ice40.check(data + b'user') == data + b'user'
+    assert ice40.check(DATA) == DATA
+    with pytest.raises(ValueError):
+        ice40.check(data[:-110])
+
+
+def test_simulated_bit_errors():
+    # prepare
+    fpga, flash = simulated_fpga(program_error_rate=0.0001)
+    data = (DATA_4096 * 4).encode()
+    # run
+    assert fpga.program(0x30000, data)
+    # check
+    assert flash.memory[0x30000:0x30000 + len(data)] == data
+    assert flash.stats[0x20] > 0  # some sectors were rewritten
+
+
+def test_simulated_early_status_read():
+    # prepare: the timing engine never polls before FlashTiming.MIN_DELAY
+    fpga, flash = simulated_fpga(latency=0,
+                                 min_status_delay=FlashTiming.MIN_DELAY)
+    # run & check
+    assert fpga.program(0x30000, DATA)
+    fpga.timing.MIN_DELAY = 0
+    fpga.timing.estimates[0x02] = 0
+    fpga.write(0x31000, b'\x00' * 16)
+    assert flash.memory[0x31000:0x31010] != b'\x00' * 16
+
+
+def test_telemetry():
+    # prepare
+    clock = VirtualClock()
+    events = []
+    telemetry = Telemetry(events.append, timer=clock.time, interval=1)
+    # run
+    telemetry.phase('write', 300)
+    clock.sleep(1)
+    telemetry.advance(100)
+    telemetry.command(0x02, 0.0015, count=2)
+    telemetry.command(0x02, 1)
+    telemetry.busy_poll()
+    telemetry.advance(100)
+    telemetry.retry(0x30000, 1)
+    telemetry.phase(None)
+    # check
+    assert [e['event'] for e in events] == [
+        'phase_start', 'progress', 'retry', 'phase_end']
+    assert events[1]['rate'] == 100
+    assert events[1]['eta'] == 2
+    assert events[3]['bytes'] == 200
+    assert events[3]['seconds'] == 1
+    assert telemetry.current == 'idle'
+    stats = telemetry.phases['write']
+    assert (stats['commands'], stats['busy_polls'], stats['retries']) == (
+        3, 1, 1)
+    assert stats['latency'] == {'02': [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1]}
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_simulated_telemetry(pipelined):
+    # prepare
+    events = []
+    fpga, _ = simulated_fpga()
+    fpga.telemetry = Telemetry(events.append)
+    # run
+    assert fpga.program(0x30000, DATA_4096.encode(), pipelined=pipelined)
+    # check
+    assert [e['phase'] for e in events if e['event'] == 'phase_end'] == [
+        'erase', 'write', 'verify']
+    assert all(json.loads(json.dumps(e)) == e for e in events)
+    assert fpga.telemetry.phases['write']['bytes'] == 4096
+    assert fpga.telemetry.current == 'idle'
+
+
+def test_simulated_telemetry_window():
+    # prepare
+    fpga, _ = simulated_fpga(window=4)
+    fpga.telemetry = Telemetry()
+    # run
+    assert fpga.program(0x30000, DATA_4096.encode())
+    # check: write enable and page program share a transfer, charged to
+    # the page program
+    latency = fpga.telemetry.phases['write']['latency']
+    assert sum(latency['02']) == 256
+    assert '06' not in latency
+
+
+@pytest.mark.parametrize('window, verify_round_trips', [(1, 256), (16, 16)])
+def test_bench_run(window, verify_round_trips):
+    # run
+    result = bench.run_simulated(0x1000, 0x30000, window=window)
+    # check
+    assert result['success']
+    assert list(result['phases']) == ['erase', 'write', 'verify']
+    erase, write, verify = result['phases'].values()
+    assert erase['erase_ops'] == 1
+    assert write['page_programs'] == 256
+    assert write['status_polls'] == 256
+    assert verify['round_trips'] == verify_round_trips
+    assert result['seconds'] == pytest.approx(
+        sum(p['seconds'] for p in result['phases'].values()))
+
+
+def test_bench_main(capsys):
+    # run
+    assert bench.main(['--sizes', '256', '--addrs', '0x30000,0x30010',
+                       '--write-sizes', '16,256', '--json', '-']) == 0
+    # check
+    results = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+    assert [(r['addr'], r['write_size']) for r in results] == [
+        (0x30000, 16), (0x30000, 256), (0x30010, 16), (0x30010, 256)]
+    assert results[1]['phases']['write']['page_programs'] == 1
+    assert results[3]['phases']['write']['page_programs'] == 2
+
+
+@pytest.mark.parametrize('argv, message', [
+    (['--addrs', '0x2ff00'], 'outside of the flash'),
+    (['--addrs', '0x7ff00', '--sizes', '0x200'], 'outside of the flash'),
+    (['--com', 'COM3'], 'Bootloader not active on COM3'),
+])
+def test_bench_main_refused(monkeypatch, capsys, argv, message):
+    # prepare: a board that isn't in the bootloader
+    bootloader = SimulatedBootloader()
+    bootloader.booted = True
+    monkeypatch.setattr(session, 'Session', lambda port: Session(
+        port, opener=lambda port: bootloader))
+    # run / check: nothing was programmed
+    assert bench.main(argv) == 1
+    assert message in capsys.readouterr().out
+    assert bootloader.flash.stats == {}
+
+
+def test_trace():
+    # prepare: record programming a simulated board
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock, seed=0)
+    bootloader = SimulatedBootloader(flash, latency=0.001, clock=clock)
+    f = io.BytesIO()
+    recorder = trace.TraceRecorder(bootloader, f, timer=clock.time)
+    fpga = TinyFPGAB(recorder, timing=FlashTiming(sleep=clock.sleep,
+                                                  timer=clock.time))
+    data = DATA_4096.encode()
+    assert fpga.is_bootloader_active()
+    assert fpga.program_bitstream(0x30000, data)
+    f.seek(0)
+    records = list(trace.read_trace(f))
+
+    def run(fpga):
+        assert fpga.is_bootloader_active()
+        assert fpga.program_bitstream(0x30000, data)
+
+    # run
+    result = trace.profile(records)
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+    trace.report(result, out)
+    trace.replay(records, run)
+    # check
+    assert len(result['busy'][0x02]) == 256
+    assert len(result['busy'][0x20]) == 1
+    # the verify reads and the one of the bootloader detection
+    assert len(result['latencies'][0x0b]) == 257
+    assert len(result['latencies'][None]) == 1
+    assert result['seconds'] == pytest.approx(clock.time(), abs=0.01)
+    assert 'busy 02 page program' + ' ' * 8 + '256' in out.getvalue()
+    with pytest.raises(IOError, match='different data written'):
+        trace.replay(records, lambda fpga: fpga.program_bitstream(
+            0x31000, data))
+    with pytest.raises(IOError, match='more calls'):
+        trace.replay(records, lambda fpga: fpga.is_bootloader_active())
+
+
+def test_trace_invalid():
+    # run / check
+    with pytest.raises(ValueError, match='Not a trace'):
+        list(trace.read_trace(io.BytesIO(b'TFBT\x00')))
+    with pytest.raises(ValueError, match='Truncated'):
+        list(trace.read_trace(io.BytesIO(trace.MAGIC + b'W\x00')))
+
+
+def test_trace_main(monkeypatch, capsys, tmpdir):
+    # prepare: record programming a padded bitstream, which the CLI trims
+    path = str(tmpdir.join('program.trace'))
+    status, _, _, image = simulated_cli(
+        monkeypatch, tmpdir, 'A', None, ['--trace', path, '-w', '16'],
+        ice40_bitstream(padding=b'\xff' * 0x1000))
+    assert status == 0
+    capsys.readouterr()
+    # run
+    replayed = trace.main([path, '-p', image, '-w', '16'])
+    # check
+    out = capsys.readouterr().out
+    assert replayed == 0
+    assert 'latency 02 page program' in out
+    assert 'Replayed in ' in out
+    # with its padding, the bitstream isn't what was programmed
+    assert trace.main([path, '-p', image, '-w', '16', '--force']) == 1
+    assert 'Trace diverges' in capsys.readouterr().out
@@ -1,42 +1,524 @@
+import bisect
+import collections
+import gzip
 import struct
 import time
+import timeit
+
+# AT25SF041: 4 Mbit, addresses past the end wrap around to the bootloader
+FLASH_SIZE = 0x80000
+
+# the bootloader lives below the user image
+USER_ADDR = 0x30000
+
+
+def check_range(addr, length, protect=0):
+    # raise ValueError for a range that isn't within the flash or starts
+    # below protect
+    if addr < protect or length < 0 or addr + length > FLASH_SIZE:
+        raise ValueError('Range {:06x}-{:06x} outside of the flash from '
+                         '{:06x} to {:06x}'.format(addr, addr + length,
+                                                   protect, FLASH_SIZE))
+
+
+def _diff_ranges(addr, expected, actual):
+    # byte ranges that differ, skipping identical 256 byte pages with a
+    # single slice comparison each
+    ranges = []
+    for page in range(0, len(expected), 256):
+        if expected[page:page + 256] == actual[page:page + 256]:
+            continue
+        for i in range(page, min(page + 256, len(expected))):
+            if expected[i:i + 1] == actual[i:i + 1]:
+                continue
+            if ranges and ranges[-1][1] == addr + i:
+                ranges[-1] = (ranges[-1][0], addr + i + 1)
+            else:
+                ranges.append((addr + i, addr + i + 1))
+    return ranges
+
+
+def mismatch_map(addr, expected, actual):
+    # compare the data read back from addr with what was written, 4k sector
+    # by 4k sector.  returns a list of (sector_addr, byte_ranges) for the
+    # sectors that differ, with absolute (start, end) byte ranges; missing
+    # bytes of a short read count as differing.
+    result = []
+    end = addr + len(expected)
+    sector_addr = addr
+    while sector_addr < end:
+        sector_end = min((sector_addr & ~0xfff) + 0x1000, end)
+        start, stop = sector_addr - addr, sector_end - addr
+        if expected[start:stop] != actual[start:stop]:
+            result.append((sector_addr & ~0xfff, _diff_ranges(
+                sector_addr, expected[start:stop], actual[start:stop])))
+        sector_addr = sector_end
+    return result
+
+
+def diff_plan(addr, current, data):
+    # classify every 4k sector of a range: unchanged, programmable in place
+    # (bits only go from 1 to 0) or needing an erase.  returns the (start,
+    # end) ranges to erase, the 256 byte page ranges to program in place
+    # and the number of unchanged sectors.
+    erase_ranges = []
+    program_ranges = []
+    unchanged = 0
+    end = addr + len(data)
+    sector_addr = addr
+    while sector_addr < end:
+        sector_end = min((sector_addr & ~0xfff) + 0x1000, end)
+        old = bytearray(current[sector_addr - addr:sector_end - addr])
+        new = bytearray(data[sector_addr - addr:sector_end - addr])
+        if old == new:
+            unchanged += 1
+        elif len(old) == len(new) and all(
+                o & n == n for o, n in zip(old, new)):
+            # only program the 256 byte pages that actually differ
+            page_addr = sector_addr
+            while page_addr < sector_end:
+                page_end = min((page_addr & ~0xff) + 0x100, sector_end)
+                start, stop = page_addr - addr, page_end - addr
+                if current[start:stop] != data[start:stop]:
+                    program_ranges.append((page_addr, page_end))
+                page_addr = page_end
+        elif erase_ranges and erase_ranges[-1][1] == sector_addr:
+            # merge with the previous sector so that erase() can use the
+            # 32k and 64k block erase opcodes
+            erase_ranges[-1] = (erase_ranges[-1][0], sector_end)
+        else:
+            erase_ranges.append((sector_addr, sector_end))
+        sector_addr = sector_end
+    return erase_ranges, program_ranges, unchanged
+
+
+def program_plan(addr, data, current=None):
+    # what programming data at addr takes: the (start, end) ranges to
+    # erase, the (addr, data) writes and the number of unchanged sectors.
+    # with the current flash contents, only the sectors that changed are
+    # erased and only the pages that changed are written.  either way the
+    # writes are all that needs a readback.
+    if current is None:
+        return [(addr, addr + len(data))], [(addr, data)], 0
+    erase_ranges, program_ranges, unchanged = diff_plan(addr, current, data)
+    writes = [(start, data[start - addr:stop - addr])
+              for start, stop in sorted(erase_ranges + program_ranges)]
+    return erase_ranges, writes, unchanged
+
+
+def verify_plan(addr, data, read_back):
+    # split a range by what was read back from it: the (addr, length)
+    # ranges that hold the data and the (addr, data) parts of 4k sectors
+    # that need rewriting
+    if read_back == data:
+        return [(addr, len(data))] if data else [], []
+    good = []
+    rewrites = []
+    end = addr + len(data)
+    start = addr
+    for sector_addr, _ in mismatch_map(addr, data, read_back):
+        # only rewrite the part of the sector within the range
+        page_addr = max(sector_addr, addr)
+        page_end = min(sector_addr + 0x1000, end)
+        if start < page_addr:
+            good.append((start, page_addr - start))
+        rewrites.append((page_addr, data[page_addr - addr:page_end - addr]))
+        start = page_end
+    if start < end:
+        good.append((start, end - start))
+    return good, rewrites
+
+
+def erased_ranges(addr, data, granularity=0x1000):
+    # (start, end) ranges of the aligned blocks of data that are all 0xff,
+    # i.e. erased flash; adjacent blocks are merged
+    ranges = []
+    end = addr + len(data)
+    block_addr = addr
+    while block_addr < end:
+        block_end = min((block_addr // granularity + 1) * granularity, end)
+        block = data[block_addr - addr:block_end - addr]
+        if block.count(b'\xff') == len(block):
+            if ranges and ranges[-1][1] == block_addr:
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((block_addr, block_end))
+        block_addr = block_end
+    return ranges
+
+
+def xor_delta(base_chunks, chunks):
+    # XOR chunks with the base image, which counts as erased flash (0xff)
+    # past its end.  this both makes a delta and applies one, and yields
+    # chunks of the same sizes as `chunks`
+    base_chunks = iter(base_chunks)
+    buffered = bytearray()
+    for chunk in chunks:
+        while len(buffered) < len(chunk):
+            base_chunk = next(base_chunks, None)
+            if base_chunk is None:
+                buffered += b'\xff' * (len(chunk) - len(buffered))
+            else:
+                buffered += base_chunk
+        yield bytes(bytearray(
+            a ^ b for a, b in zip(bytearray(chunk), buffered)))
+        del buffered[:len(chunk)]
+
+
+def group_regions(regions):
+    # sort (addr, data) regions and group the ones sharing a 4k sector
+    groups = []
+    end = None
+    for addr, data in sorted(regions, key=lambda region: region[0]):
+        if not data:
+            continue
+        if end is not None and addr < end:
+            raise ValueError('Overlapping regions at {:06x}'.format(addr))
+        if end is not None and addr & ~0xfff < (end + 0xfff) & ~0xfff:
+            groups[-1].append((addr, data))
+        else:
+            groups.append([(addr, data)])
+        end = addr + len(data)
+    return groups
+
+
+class ErasePlan(object):
+    # erase operations for a range, planned up front.  the erase opcodes
+    # work on aligned 4k sectors and 32k/64k blocks, so the range is
+    # widened to whole sectors and the parts of the first and last sectors
+    # that are outside of it are read back before erasing and restored
+    # afterwards:
+    #
+    # start                                                      end
+    # v                                                          v
+    # +------------------+-----------------------+---------------+
+    # |       keep       |  erase (4k, 32k, 64k) |     keep      |
+    # +------------------+-----------------------+---------------+
+    #                    ^ addr                  ^ addr + length
+    #
+    # taking the largest aligned block at each step gives the minimal
+    # number of operations; widening further to use a larger block would
+    # trade a few cheap erases for a slow read-modify-write.
+    OPCODES = ((64 * 1024, 0xd8), (32 * 1024, 0x52), (4 * 1024, 0x20))
+
+    def __init__(self, addr, length):
+        self.ops = []  # (opcode, addr, length)
+        self.preserve = []  # (addr, length)
+        self.estimated_time = None  # seconds, filled in by plan_erase
+        if length <= 0:
+            return
+        start = addr & ~0xfff
+        end = (addr + length + 0xfff) & ~0xfff
+        if start < addr:
+            self.preserve.append((start, addr - start))
+        if addr + length < end:
+            self.preserve.append((addr + length, end - addr - length))
+        while start < end:
+            for size, opcode in self.OPCODES:
+                if start % size == 0 and start + size <= end:
+                    break
+            self.ops.append((opcode, start, size))
+            start += size
+
+    def __len__(self):
+        return len(self.ops)
+
+
+# time.sleep can oversleep by a whole timer tick, 1 to 15 ms on Windows
+# before Python 3.11, which is longer than a page program
+SPIN_TIME = 0.002
+
+
+def precise_sleep(seconds, timer=timeit.default_timer):
+    # sleep for the bulk of a long wait and spin, yielding to other
+    # threads, through the last SPIN_TIME of it
+    deadline = timer() + seconds
+    if seconds > SPIN_TIME:
+        time.sleep(seconds - SPIN_TIME)
+    while timer() < deadline:
+        time.sleep(0)
+
+
+class FlashTiming(object):
+    # initial estimates of how long the flash stays busy after each opcode,
+    # in seconds, roughly the typical values from the datasheets.  they are
+    # refined with the measured durations as programming goes on.
+    DATASHEET = {
+        b'\x1f\x84\x01': {  # AT25SF041
+            0x02: 0.0007,
+            0x20: 0.05,
+            0x52: 0.15,
+            0xd8: 0.25,
+        },
+    }
+
+    # FIXME: this is a workaround for a bug in the bootloader verilog.  if
+    #        the status register read comes too early, then it corrupts the
+    #        SPI flash write in progress.
+    MIN_DELAY = 70e-6
+
+    def __init__(self, devid=b'\x1f\x84\x01', sleep=precise_sleep,
+                 timer=timeit.default_timer):
+        self.estimates = dict(self.DATASHEET.get(devid, {}))
+        self.sleep = sleep
+        self.timer = timer
+        self.opcode = None
+        self.started = None
+        self.busy_seen = None
+
+    def start(self, opcode):
+        self.opcode = opcode
+        self.started = self.timer()
+        self.busy_seen = None
+
+    def busy_at(self, polled):
+        # a status read sent at `polled` found the flash still busy
+        self.busy_seen = polled
+
+    def first_poll_delay(self):
+        # sleep through most of the expected busy time before the first
+        # status read, each poll costs a USB round trip
+        estimate = self.estimates.get(self.opcode, 0)
+        elapsed = self.timer() - self.started if self.started else 0
+        return max(self.MIN_DELAY, 0.8 * estimate - elapsed)
+
+    def poll_interval(self):
+        return max(10e-6, self.estimates.get(self.opcode, 0) / 10)
+
+    def done(self, polled=None):
+        # the status read sent at `polled` found the flash idle
+        if self.started is None:
+            return
+        if polled is None:
+            polled = self.timer()
+        # use the times the status reads were sent, not when their answers
+        # came back, or the USB latency would creep into the estimates
+        estimate = self.estimates.get(self.opcode)
+        if self.busy_seen is None:
+            # idle at the first status read: done at some point before it,
+            # so a read that came late because the sleep overshot can only
+            # lower the estimate, never raise it
+            elapsed = polled - self.started
+            if estimate is not None:
+                elapsed = min(elapsed, estimate)
+        else:
+            elapsed = (self.busy_seen + polled) / 2 - self.started
+        if estimate is None:
+            self.estimates[self.opcode] = elapsed
+        else:
+            self.estimates[self.opcode] = 0.8 * estimate + 0.2 * elapsed
+        self.opcode = None
+        self.started = None
+        self.busy_seen = None
+
+
+class Telemetry(object):
+    # collects per-phase programming metrics.  `listener`, if given, is
+    # called with every event as a dict: phase_start, progress (at most
+    # every `interval` seconds, with rate and ETA), retry and phase_end
+    # (with the metrics of the phase).
+    LATENCY_BUCKETS = (100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3,
+                       20e-3, 50e-3, 100e-3)
+
+    def __init__(self, listener=None, timer=timeit.default_timer,
+                 interval=0.5):
+        self.listener = listener
+        self.timer = timer
+        self.interval = interval
+        self.phases = collections.OrderedDict()
+        self.current = None
+        self._start_phase('idle', None)
+
+    def _emit(self, event, **fields):
+        if self.listener is not None:
+            fields['event'] = event
+            fields['time'] = time.time()
+            self.listener(fields)
+
+    def _start_phase(self, name, total):
+        self.current = name
+        self.stats = self.phases.setdefault(name, {
+            'seconds': 0.0,
+            'bytes': 0,
+            'total': 0,
+            'commands': 0,
+            'busy_polls': 0,
+            'retries': 0,
+            # opcode -> transfer count per LATENCY_BUCKETS bucket, the
+            # last one for anything slower
+            'latency': {},
+        })
+        self.stats['total'] += total or 0
+        self.started = self.last_report = self.timer()
+        self.done = 0
+        self.total = total
+
+    def phase(self, name, total=None):
+        # end the current phase and start the next one (None for none)
+        now = self.timer()
+        seconds = now - self.started
+        self.stats['seconds'] += seconds
+        if self.current != 'idle':
+            self._emit('phase_end', phase=self.current, bytes=self.done,
+                       total=self.total, seconds=seconds,
+                       rate=self.done / seconds if seconds else None,
+                       commands=self.stats['commands'],
+                       busy_polls=self.stats['busy_polls'],
+                       retries=self.stats['retries'],
+                       latency=self.stats['latency'])
+        self._start_phase('idle' if name is None else name, total)
+        if name is not None:
+            self._emit('phase_start', phase=name, total=total)
+
+    def advance(self, length):
+        self.stats['bytes'] += length
+        self.done += length
+        if self.listener is None:
+            return
+        now = self.timer()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            rate = self.done / (now - self.started)
+            eta = None
+            if self.total and rate:
+                eta = max(self.total - self.done, 0) / rate
+            self._emit('progress', phase=self.current, bytes=self.done,
+                       total=self.total, rate=rate, eta=eta)
+
+    def command(self, opcode, seconds, count=1):
+        # one transfer of `count` commands ending with opcode, answered
+        # after `seconds`
+        self.stats['commands'] += count
+        key = '{:02x}'.format(opcode)
+        histogram = self.stats['latency'].get(key)
+        if histogram is None:
+            histogram = self.stats['latency'][key] = [0] * (
+                len(self.LATENCY_BUCKETS) + 1)
+        histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def busy_poll(self):
+        self.stats['busy_polls'] += 1
+
+    def retry(self, addr, attempt):
+        self.stats['retries'] += 1
+        self._emit('retry', phase=self.current, addr=addr, attempt=attempt)
 
 
 class TinyFPGAB(object):
-    def __init__(self, ser, progress=None):
+    # seconds between attempts to rewrite a sector, doubled every time
+    RETRY_DELAY = 0.01
+    MAX_RETRY_DELAY = 1.0
+
+    def __init__(self, ser, progress=None, window=1, read_size=16,
+                 write_size=16, cache=None, timing=None, telemetry=None,
+                 journal=None):
+        # the original bootloader only supports transfers of up to 16 bytes
+        # and crashes on anything longer, so bigger chunks are opt-in
+        if not 0 < read_size < 0xffff:
+            raise ValueError('Invalid read size: {}'.format(read_size))
+        if not 0 < write_size <= 256:
+            raise ValueError('Invalid write size: {}'.format(write_size))
         self.ser = ser
-        self.spinner = 0
+        self.window = window
+        self.read_size = read_size
+        self.write_size = write_size
+        self.cache = cache
+        self.journal = journal
+        self.timing = FlashTiming() if timing is None else timing
+        self.telemetry = telemetry
+        # reused for every transfer, so moving a large image or dump
+        # doesn't allocate per command
+        self._tx = bytearray()
+        self._rx = bytearray()
         if progress is None:
             self.progress = lambda x: x
         else:
             self.progress = progress
 
-    def is_bootloader_active(self):
-        time.sleep(0.1)
-        for i in range(6):
+    def is_bootloader_active(self, attempts=6):
+        # every command waits for the bootloader's answer, so there is no
+        # need to sleep between them; return as soon as the flash answers.
+        # a wake can get lost while the flash leaves deep power down, hence
+        # the retries.
+        for i in range(attempts):
             self.wake()
-            time.sleep(0.001)
             self.read(0, 16)
-            time.sleep(0.001)
             self.wake()
-            time.sleep(0.001)
             devid = self.read_id()
             expected_devid = b'\x1f\x84\x01'
             if devid == expected_devid:
                 return True
-            time.sleep(0.05)
+            self.timing.sleep(0.05)
         return False
 
-    def cmd(self, opcode, addr=None, data=b'', read_len=0):
-        assert isinstance(data, bytes)
-        cmd_read_len = read_len + 1 if read_len else 0
-        addr = b'' if addr is None else struct.pack('>I', addr)[1:]
-        write_string = bytearray([opcode]) + addr + data
-        cmd_write_string = b'\x01' + struct.pack(
-            '<HH', len(write_string), cmd_read_len) + write_string
-        self.ser.write(bytearray(cmd_write_string))
+    @staticmethod
+    def _append_frame(frames, opcode, addr=None, data=b'', read_len=0):
+        # append a frame to the frames bytearray in place; data can be any
+        # bytes-like object, e.g. a memoryview into the bitstream
+        write_len = 1 + len(data) + (0 if addr is None else 3)
+        frames += struct.pack('<BHHB', 0x01, write_len,
+                              read_len + 1 if read_len else 0, opcode)
+        if addr is not None:
+            frames += struct.pack('>I', addr)[1:]
+        frames += data
+        return frames
+
+    @staticmethod
+    def _frame(opcode, addr=None, data=b'', read_len=0):
+        return TinyFPGAB._append_frame(bytearray(), opcode, addr, data,
+                                       read_len)
+
+    def _receive(self, length):
+        # read into the receive buffer; the memoryview returned is only
+        # valid until the next transfer
+        if len(self._rx) < length:
+            self._rx = bytearray(length)
+        view = memoryview(self._rx)[:length]
+        if not length:
+            return view
+        readinto = getattr(self.ser, 'readinto', None)
+        if readinto is not None:
+            return view[:readinto(view)]
+        data = self.ser.read(length)
+        view[:len(data)] = data
+        return view[:len(data)]
+
+    def _transfer(self, commands):
+        # one serial write with the frames of the (opcode, addr, data,
+        # read_len) commands, returns their concatenated responses
+        tx = self._tx
+        del tx[:]
+        for command in commands:
+            self._append_frame(tx, *command)
+        telemetry = self.telemetry
+        if telemetry is not None:
+            started = telemetry.timer()
+        self.ser.write(tx)
         self.ser.flush()
-        return self.ser.read(read_len)
+        response = self._receive(sum(command[3] for command in commands))
+        if telemetry is not None:
+            # charged to the last command, e.g. the page program after its
+            # write enable
+            telemetry.command(commands[-1][0], telemetry.timer() - started,
+                              len(commands))
+        return response
+
+    def cmd(self, opcode, addr=None, data=b'', read_len=0):
+        return self._transfer([(opcode, addr, data, read_len)]).tobytes()
+
+    def cmds(self, commands):
+        # send commands with up to `window` frames per serial write, then
+        # split the concatenated response back into one result per command
+        commands = list(commands)
+        responses = []
+        for i in range(0, len(commands), self.window):
+            batch = commands[i:i + self.window]
+            data = self._transfer(batch)
+            offset = 0
+            for command in batch:
+                responses.append(data[offset:offset + command[3]].tobytes())
+                offset += command[3]
+        return responses
 
     def sleep(self):
         self.cmd(0xb9)
@@ -50,15 +532,67 @@ class TinyFPGAB(object):
     def read_sts(self):
         return self.cmd(0x05, read_len=1) or '1'
 
+    def _done(self, length):
+        self.progress(length)
+        if self.telemetry is not None:
+            self.telemetry.advance(length)
+
+    def _phase(self, name, total=None):
+        if self.telemetry is not None:
+            self.telemetry.phase(name, total)
+
+    def _read_commands(self, ranges):
+        # fast reads of up to read_size bytes, tagged with their range
+        commands = []
+        for index, (addr, length) in enumerate(ranges):
+            while length > 0:
+                read_length = min(self.read_size, length)
+                commands.append((index, (0x0b, addr, b'\x00', read_length)))
+                addr += read_length
+                length -= read_length
+        return commands
+
+    def _read_ranges(self, ranges):
+        # read several (addr, length) ranges, sharing transfers between
+        # them; returns a bytearray for each range, filled in place
+        commands = self._read_commands(ranges)
+        data = [bytearray(length) for _, length in ranges]
+        filled = [0] * len(ranges)
+        # queue up to one window worth of fast reads per transfer
+        for i in range(0, len(commands), self.window):
+            batch = commands[i:i + self.window]
+            response = self._transfer([command for _, command in batch])
+            offset = 0
+            for index, command in batch:
+                # a short read leaves the rest of the range out
+                piece = response[offset:offset + command[3]]
+                offset += command[3]
+                data[index][filled[index]:filled[index] + len(piece)] = piece
+                filled[index] += len(piece)
+                self._done(len(piece))
+        return [buf if length == len(buf) else buf[:length]
+                for buf, length in zip(data, filled)]
+
     def read(self, addr, length):
-        data = b''
-        while length > 0:
-            read_length = min(16, length)
-            data += self.cmd(0x0b, addr, b'\x00', read_len=read_length)
-            self.progress(read_length)
-            addr += read_length
-            length -= read_length
-        return data
+        return self._read_ranges([(addr, length)])[0]
+
+    def dump(self, addr, length, chunk_size=64 * 1024):
+        # yield (addr, data) for the flash contents, chunk_size bytes at a
+        # time, so large ranges can be streamed out
+        self._phase('dump', length)
+        try:
+            end = addr + length
+            while addr < end:
+                # chunks are aligned, so no sector is split between two
+                chunk_length = min(chunk_size - addr % chunk_size, end - addr)
+                chunk = self.read(addr, chunk_length)
+                if len(chunk) != chunk_length:
+                    raise IOError('Short read at {:06x}: {} of {} bytes'
+                                  .format(addr, len(chunk), chunk_length))
+                yield addr, chunk
+                addr += chunk_length
+        finally:
+            self._phase(None)
 
     def write_enable(self):
         self.cmd(0x06)
@@ -67,14 +601,19 @@ class TinyFPGAB(object):
         self.cmd(0x04)
 
     def wait_while_busy(self):
-        # FIXME: this is a workaround for a bug in the bootloader verilog.  if
-        #        the status register read comes too early, then it corrupts the
-        #        SPI flash write in progress.  this busy loop waits long enough
-        #        such that the write data has finished and data corruption is
-        #        no longer possible.
-        self._delay_micros(70)
-        while ord(self.read_sts()) & 1:
-            self._delay_micros(10)
+        # the timing engine knows which operation is in progress and never
+        # polls before FlashTiming.MIN_DELAY, see the FIXME there
+        timing = self.timing
+        timing.sleep(timing.first_poll_delay())
+        while True:
+            polled = timing.timer()
+            if not ord(self.read_sts()) & 1:
+                break
+            if self.telemetry is not None:
+                self.telemetry.busy_poll()
+            timing.busy_at(polled)
+            timing.sleep(timing.poll_interval())
+        timing.done(polled)
 
     def _erase(self, addr, length):
         opcode = {
@@ -84,165 +623,401 @@ class TinyFPGAB(object):
         }[length]
         self.write_enable()
         self.cmd(opcode, addr)
+        self.timing.start(opcode)
         self.wait_while_busy()
 
+    def plan_erase(self, addr, length):
+        plan = ErasePlan(addr, length)
+        estimates = self.timing.estimates
+        page_programs = 0
+        for restore_addr, restore_length in plan.preserve:
+            # same chunking as write()
+            while restore_length > 0:
+                write_length = min(self.write_size, restore_length,
+                                   256 - (restore_addr & 0xff))
+                restore_addr += write_length
+                restore_length -= write_length
+                page_programs += 1
+        plan.estimated_time = (
+            sum(estimates.get(opcode, 0) for opcode, _, _ in plan.ops) +
+            page_programs * estimates.get(0x02, 0))
+        return plan
+
     def erase(self, addr, length):
-        possible_lengths = (1, 4 * 1024, 32 * 1024, 64 * 1024)
-
-        while length > 0:
-            erase_length = max(p for p in possible_lengths
-                               if p <= length and addr % p == 0)
-
-            if erase_length == 1:
-                # there are no opcode to erase that much
-                # either we want to erase up to multiple of 0x1000
-                # or we want to erase up to length
-
-                # start_addr                            end_addr
-                # v                                     v
-                # +------------------+------------------+----------------+
-                # |       keep       |      erase       |      keep      |
-                # +------------------+------------------+----------------+
-                #  <- start_length -> <- erase_length -> <- end_length ->
-
-                start_addr = addr & 0xfff000
-                start_length = addr & 0xfff
-                erase_length = min(0x1000 - start_length, length)
-                end_addr = start_addr + start_length + erase_length
-                end_length = start_addr + 0x1000 - end_addr
-
-                # read data we need to restore later
-                if start_length:
-                    start_read_data = self.read(start_addr, start_length)
-                if end_length:
-                    end_read_data = self.read(end_addr, end_length)
-
-                # erase the block
-                self._erase(start_addr, 0x1000)
-
-                # restore data
-                if start_length:
-                    self.write(start_addr, start_read_data)
-                if end_length:
-                    self.write(end_addr, end_read_data)
+        if self.cache is not None:
+            self.cache.invalidate(addr, length)
+        plan = self.plan_erase(addr, length)
 
-            else:
-                # there is an opcode to erase that much data
-                self.progress(erase_length)
-                self._erase(addr, erase_length)
+        # read all data we need to restore later before erasing anything
+        restore_data = self._read_ranges(plan.preserve)
 
-            # update
-            length -= erase_length
-            addr += erase_length
+        for opcode, erase_addr, erase_length in plan.ops:
+            self._done(erase_length)
+            self._erase(erase_addr, erase_length)
 
-    def _delay_micros(self, micros):
-        import timeit
-        seconds = micros / 1000000.0
-        t = timeit.default_timer()
-        while timeit.default_timer() - t < seconds:
-            self.spinner = (self.spinner + 1) & 0xff
+        # restore data
+        for (restore_addr, _), data in zip(plan.preserve, restore_data):
+            self.write(restore_addr, data)
 
     # don't use this directly, use the public "write" function instead
     def _write(self, addr, data):
-        self.write_enable()
-        self.cmd(0x02, addr, data)
+        if self.window > 1:
+            # neither command expects a response, so they can share a
+            # transfer; the status poll still has to wait for the result
+            self.cmds([(0x06, None, b'', 0), (0x02, addr, data, 0)])
+        else:
+            self.write_enable()
+            self.cmd(0x02, addr, data)
+        self.timing.start(0x02)
         self.wait_while_busy()
-        self.progress(len(data))
-
-    def write(self, addr, data):
-        while data:
+        self._done(len(data))
+
+    def _write_chunks(self, addr, data):
+        # page programs can't cross a 256 byte boundary.  programming 0xff
+        # leaves a byte as it is, so chunks of only 0xff are skipped, e.g.
+        # the unused parts of an iCE40 bitstream after an erase.  chunks are
+        # memoryviews into data, nothing is copied.
+        view = memoryview(data)
+        blank = b'\xff' * 256
+        offset = 0
+        while offset < len(view):
             dist_to_256_byte_boundary = 256 - (addr & 0xff)
-            write_length = min(16, len(data), dist_to_256_byte_boundary)
-            self._write(addr, data[:write_length])
-            data = data[write_length:]
+            write_length = min(self.write_size, len(view) - offset,
+                               dist_to_256_byte_boundary)
+            chunk = view[offset:offset + write_length]
+            if chunk == blank[:write_length]:
+                self._done(write_length)
+            else:
+                yield addr, chunk
+            offset += write_length
             addr += write_length
 
-    def program(self, addr, data):
-        self.progress("Erasing designated flash pages")
-        self.erase(addr, len(data))
-
+    def write(self, addr, data):
+        if self.cache is not None:
+            self.cache.invalidate(addr, len(data))
+        for chunk_addr, chunk in self._write_chunks(addr, data):
+            self._write(chunk_addr, chunk)
+
+    def _read_current(self, addr, data):
+        if self.cache is None:
+            return self.read(addr, len(data))
+        # sectors the cache knows to hold the data need no readback, once
+        # the first sector of each run of them passes the spot check; read
+        # the others in runs of consecutive sectors
+        end = addr + len(data)
+        runs = []
+        sector_addr = addr
+        while sector_addr < end:
+            sector_end = min((sector_addr & ~0xfff) + 0x1000, end)
+            known = self.cache.matches(
+                sector_addr, data[sector_addr - addr:sector_end - addr])
+            if runs and runs[-1][2] == known:
+                runs[-1][1] = sector_end
+            else:
+                runs.append([sector_addr, sector_end, known])
+            sector_addr = sector_end
+        cached = [(start, data[start - addr:stop - addr])
+                  for start, stop, known in runs if known]
+        if cached and not self._cache_holds(cached):
+            self.progress("Flash changed since it was cached")
+            self.cache.invalidate()
+            return self.read(addr, len(data))
+        current = bytearray(data)
+        for start, stop, known in runs:
+            if not known:
+                current[start - addr:stop - addr] = self.read(
+                    start, stop - start)
+        return bytes(current)
+
+    def _program_diff(self, addr, data):
+        self._phase('compare', len(data))
+        self.progress("Reading current flash contents")
+        erase_ranges, writes, unchanged = program_plan(
+            addr, data, self._read_current(addr, data))
+        self._diff_summary(erase_ranges, writes, unchanged)
+
+        if erase_ranges:
+            self._phase('erase', sum(stop - start
+                                     for start, stop in erase_ranges))
+            self.progress("Erasing designated flash pages")
+            for start, stop in erase_ranges:
+                self.erase(start, stop - start)
+
+        self._phase('write', sum(len(chunk) for _, chunk in writes))
         self.progress("Writing bitstream")
-        self.write(addr, data)
-
-        self.progress("Verifying bitstream")
+        for start, chunk in writes:
+            self.write(start, chunk)
+        return writes
+
+    def _diff_summary(self, erase_ranges, writes, unchanged):
+        # every erased range is written back as a whole
+        self.progress(
+            "{} unchanged, {} erased, {} programmed in place".format(
+                unchanged, len(erase_ranges),
+                len(writes) - len(erase_ranges)))
+
+    def _verify(self, addr, data):
         read_back = self.read(addr, len(data))
-
-        if read_back == data:
-            self.progress("Success!")
-            return True
-        else:
+        for page_addr, page_data in self._rewrites(addr, data, read_back):
+            self.progress("rewriting page {:06x}".format(page_addr))
+            for attempt in range(6):
+                self.erase(page_addr, len(page_data))
+                self.write(page_addr, page_data)
+                if self._rewritten(page_addr, page_data,
+                                   self.read(page_addr, len(page_data)),
+                                   attempt):
+                    break
+                self.timing.sleep(self._retry_delay(attempt))
+            else:
+                return False
+        return True
+
+    def _rewrites(self, addr, data, read_back):
+        # the sectors that made it are recorded right away, so that a retry
+        # after an error only does the others
+        good, rewrites = verify_plan(addr, data, read_back)
+        for start, length in good:
+            self._verified(start, length)
+        if rewrites:
+            self._phase('rewrite', sum(len(page_data)
+                                       for _, page_data in rewrites))
             self.progress("Need to rewrite some pages...")
-
             self.progress(
-                "len: {:06x} {:06x}"
-                .format(len(data), len(read_back)))
-
-            mismatch_4k_pages = set()
-            for i in range(min(len(data), len(read_back))):
-                if read_back[i] != data[i]:
-                    mismatch_4k_pages.add(i >> 12)
-
-            for page in mismatch_4k_pages:
-                page_offset = page << 12
-                page_addr = addr + page_offset
-                page_len = min(4 * 1024, len(data) - page_offset)
-                page_data = data[page_offset:page_offset + page_len]
-                self.progress("rewriting page {:06x}".format(page_addr))
-                success = True
-                for attempt in range(6):
-                    self.erase(page_addr, page_len)
-                    self.write(page_addr, page_data)
-                    page_read_back_data = self.read(page_addr, page_len)
-
-                    if len(page_read_back_data) != len(page_data):
-                        success = False
-                    else:
-                        for i in range(page_len):
-                            if page_read_back_data[i] != page_data[i]:
-                                self.progress(
-                                    "        diff {:06x}: {:02x} {:02x}"
-                                    .format(
-                                        i,
-                                        ord(page_read_back_data[i]),
-                                        ord(page_data[i])))
-                                success = False
-
-                    if success:
-                        break
-                    else:
-                        time.sleep(0.1)
-
-                if not success:
-                    self.progress("Verification Failed!")
-                    return False
-
-            self.progress("Success!")
+                "len: {:06x} {:06x}".format(len(data), len(read_back)))
+        return rewrites
+
+    def _rewritten(self, page_addr, page_data, read_back, attempt):
+        if read_back == page_data:
+            self._verified(page_addr, len(page_data))
             return True
+        if len(read_back) == len(page_data):
+            for start, end in _diff_ranges(page_addr, page_data, read_back):
+                self.progress("        diff {:06x}-{:06x}".format(start, end))
+        if self.telemetry is not None:
+            self.telemetry.retry(page_addr, attempt)
+        return False
+
+    def _retry_delay(self, attempt):
+        # back off more and more, in case the board needs time
+        return min(self.RETRY_DELAY * 2 ** attempt, self.MAX_RETRY_DELAY)
+
+    def _verified(self, addr, length):
+        if self.journal is not None:
+            self.journal.record(addr, length)
+
+    def _program_pipelined(self, addr, data):
+        # erase, write and verify one 64k block at a time, so a bad sector
+        # is retried right away instead of after a full pass
+        end = addr + len(data)
+        block_addr = addr
+        while block_addr < end:
+            block_end = min((block_addr & ~0xffff) + 0x10000, end)
+            block_data = data[block_addr - addr:block_end - addr]
+            self.progress("Programming block {:06x}".format(block_addr))
+            self._phase('erase', len(block_data))
+            self.erase(block_addr, len(block_data))
+            self._phase('write', len(block_data))
+            self.write(block_addr, block_data)
+            self._phase('verify', len(block_data))
+            if not self._verify(block_addr, block_data):
+                return False
+            block_addr = block_end
+        return True
+
+    def _spans(self, regions):
+        # regions sharing a sector are programmed as one span, with the
+        # flash contents between them read back so the erase keeps them
+        groups = group_regions(regions)
+        gaps = [(prev_addr + len(prev_data), addr - prev_addr - len(prev_data))
+                for group in groups
+                for (prev_addr, prev_data), (addr, _) in zip(group, group[1:])]
+        gap_data = iter(self._read_ranges(gaps))
+        spans = []
+        for group in groups:
+            parts = [group[0][1]]
+            for _, data in group[1:]:
+                parts.append(next(gap_data))
+                parts.append(data)
+            data = parts[0] if len(parts) == 1 else b''.join(
+                bytes(part) for part in parts)
+            spans.append((group[0][0], data))
+        return spans
+
+    def program(self, addr, data, diff=False, pipelined=False):
+        return self.program_regions([(addr, data)], diff, pipelined)
+
+    def program_regions(self, regions, diff=False, pipelined=False):
+        # program several (addr, data) regions in one session: all of them
+        # are erased, then written, then verified.  with a journal, only
+        # what it doesn't know to be verified already is programmed.
+        try:
+            if self.journal is not None:
+                total = sum(len(data) for _, data in regions)
+                regions = self.journal.remaining(regions)
+                left = sum(len(data) for _, data in regions)
+                if left < total:
+                    self.progress("Resuming, {} of {} bytes left".format(
+                        left, total))
+            success = self._program(self._spans(regions), diff, pipelined)
+            if success and self.journal is not None:
+                self.journal.finish()
+            return success
+        finally:
+            self._phase(None)
+
+    def _cache_holds(self, spans):
+        # a board reflashed with another tool leaves the cache stale, so
+        # the first sector of each span it knows about is read back
+        lengths = [min(len(data), 0x1000 - (addr & 0xfff))
+                   for addr, data in spans]
+        read_back = self._read_ranges(
+            [(addr, length) for (addr, _), length in zip(spans, lengths)])
+        return all(current == data[:length] for (_, data), length, current
+                   in zip(spans, lengths, read_back))
+
+    def _program(self, spans, diff, pipelined):
+        if self.cache is not None:
+            cached = [self.cache.matches(addr, data) for addr, data in spans]
+            if any(cached) and not self._cache_holds(
+                    [span for span, known in zip(spans, cached) if known]):
+                self.progress("Flash changed since it was cached")
+                self.cache.invalidate()
+                cached = [False] * len(spans)
+            spans = [span for span, known in zip(spans, cached) if not known]
+            if not spans:
+                self.progress("Flash already up to date")
+                self.progress("Success!")
+                return True
+        total = sum(len(data) for _, data in spans)
+
+        if pipelined and not diff:
+            success = all(self._program_pipelined(addr, data)
+                          for addr, data in spans)
+        else:
+            # the unchanged sectors of a diff were just compared, only the
+            # ranges written need a readback
+            checks = spans
+            if diff:
+                checks = []
+                for addr, data in spans:
+                    checks += self._program_diff(addr, data)
+            else:
+                self._phase('erase', total)
+                self.progress("Erasing designated flash pages")
+                for addr, data in spans:
+                    self.erase(addr, len(data))
+
+                self._phase('write', total)
+                self.progress("Writing bitstream")
+                for addr, data in spans:
+                    self.write(addr, data)
+
+            self._phase('verify', sum(len(data) for _, data in checks))
+            self.progress("Verifying bitstream")
+            success = all(self._verify(addr, data) for addr, data in checks)
+            if success and diff:
+                for addr, data in spans:
+                    self._verified(addr, len(data))
+
+        self._phase(None)
+        if not success:
+            self.progress("Verification Failed!")
+            return False
+
+        if self.cache is not None:
+            for addr, data in spans:
+                self.cache.store(addr, data)
+        self.progress("Success!")
+        return True
 
     def boot(self):
         self.ser.write(bytearray([0x00]))
         self.ser.flush()
 
-    def slurp(self, filename):
-        with open(filename, 'rb') as f:
-            bitstream = f.read()
-        if filename.endswith('.hex'):
-            bitstream = ''.join(chr(int(i, 16)) for i in bitstream.split())
-            print("Bitstream type: {}".format(type(bitstream)))
-            bitstream = str.encode(bitstream)
-        elif not filename.endswith('.bin'):
+    @staticmethod
+    def _parse_hex(text):
+        # text is whitespace separated hex bytes
+        tokens = text.split()
+        digits = b''.join(tokens)
+        if len(digits) == 2 * len(tokens):
+            return bytearray.fromhex(digits.decode('ascii'))
+        return bytearray(int(token, 16) for token in tokens)
+
+    def stream(self, filename, chunk_size=64 * 1024, base=None):
+        # return an iterator over the bitstream in chunk_size pieces (the
+        # last one may be shorter) that doesn't load the whole file.  .bin,
+        # .hex and .delta files can be gzip compressed (.gz); a .delta file
+        # holds the XOR of the bitstream with the `base` bitstream file.
+        name, opener = filename, open
+        if name.endswith('.gz'):
+            name, opener = name[:-3], gzip.open
+        if name.endswith('.bin'):
+            return self._stream_bin(filename, opener, chunk_size)
+        elif name.endswith('.hex'):
+            return self._stream_hex(filename, opener, chunk_size)
+        elif not name.endswith('.delta'):
             raise ValueError('Unknown bitstream extension')
-        return (0x30000, bitstream)
-
-    def program_bitstream(self, addr, bitstream):
+        elif base is None:
+            raise ValueError('A base bitstream is needed for ' + filename)
+        return xor_delta(self.stream(base, chunk_size),
+                         self._stream_bin(filename, opener, chunk_size))
+
+    @staticmethod
+    def _stream_bin(filename, opener, chunk_size):
+        with opener(filename, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _stream_hex(self, filename, opener, chunk_size):
+        buffered = bytearray()
+        with opener(filename, 'rb') as f:
+            pending = b''
+            while True:
+                block = f.read(3 * chunk_size)
+                text = pending + block
+                pending = b''
+                if block and not text[-1:].isspace():
+                    # the last token may continue in the next block
+                    split = max(text.rfind(c) for c in (b' ', b'\n', b'\t',
+                                                        b'\r')) + 1
+                    text, pending = text[:split], text[split:]
+                buffered += self._parse_hex(text)
+                while len(buffered) >= chunk_size:
+                    yield bytes(buffered[:chunk_size])
+                    del buffered[:chunk_size]
+                if not block:
+                    break
+        if buffered:
+            yield bytes(buffered)
+
+    def slurp(self, filename, base=None):
+        return (USER_ADDR, b''.join(self.stream(filename, base=base)))
+
+    def program_stream(self, addr, chunks):
+        # program and verify one chunk at a time, so the next chunk is only
+        # read once the previous one made it to the flash
+        for chunk in chunks:
+            if not self.program(addr, chunk):
+                return False
+            addr += len(chunk)
+        return True
+
+    def program_bitstream(self, addr, bitstream, diff=False, pipelined=False):
         self.progress("Waking up SPI flash")
         self.progress(str(len(bitstream)) + " bytes to program")
-        if self.program(addr, bitstream):
+        if self.program(addr, bitstream, diff, pipelined):
             self.boot()
             return True
+        return False
 
-        # FIXME: printing out this spinner ensures the busy loop in _write is
-        #        not optimized away
-        print("Your lucky number: " + str(self.spinner))
-
+    def program_images(self, regions, diff=False, pipelined=False):
+        self.progress("Waking up SPI flash")
+        self.progress("{} bytes in {} regions to program".format(
+            sum(len(data) for _, data in regions), len(regions)))
+        if self.program_regions(regions, diff, pipelined):
+            self.boot()
+            return True
         return False
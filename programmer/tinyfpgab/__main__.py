@@ -1,11 +1,23 @@
+import functools
+import hashlib
+import json
+import os
 import sys
+import threading
+import time
 import serial
 
 
 def _main():
     import argparse
     from serial.tools.list_ports import comports
-    from tinyfpgab import TinyFPGAB
+    from tinyfpgab import FLASH_SIZE, Telemetry, TinyFPGAB, group_regions
+    from tinyfpgab import manifest
+    from tinyfpgab import journal
+    from tinyfpgab import link
+    from tinyfpgab.cache import FlashCache
+    from tinyfpgab.session import Session, open_serial
+    from tinyfpgab.trace import TraceRecorder
 
     parser = argparse.ArgumentParser()
 
@@ -14,18 +26,96 @@ def _main():
                              "boards")
     parser.add_argument("-p", "--program", type=str,
                         help="program TinyFPGA board with the given bitstream")
+    parser.add_argument("--base", type=str,
+                        help="base bitstream that a .delta --program file "
+                             "or --make-delta is relative to")
+    parser.add_argument("--make-delta", type=str,
+                        help="write the difference of the --program "
+                             "bitstream to --base to the given .delta or "
+                             ".delta.gz file")
+    parser.add_argument("-m", "--manifest", type=str,
+                        help="program all images listed in the given JSON "
+                             "manifest in one session")
+    parser.add_argument("--dump", type=str,
+                        help="read the flash from --addr (default 0) into "
+                             "the given file, - for stdout")
+    parser.add_argument("--length", type=_number,
+                        help="number of bytes to --dump; default is up to "
+                             "the end of the flash")
+    parser.add_argument("--checksum", action="store_true",
+                        help="--dump the SHA-256 of every 4k sector instead "
+                             "of the data")
+    parser.add_argument("--sparse", action="store_true",
+                        help="--dump the non-erased parts to separate files "
+                             "listed in a manifest written to the --dump "
+                             "file")
     parser.add_argument("-b", "--boot", action="store_true",
                         help="command the TinyFPGA B-series board to exit the "
                              "bootloader and load the user configuration")
-    parser.add_argument("-c", "--com", type=str, help="serial port name")
+    parser.add_argument("-c", "--com", type=str, action="append",
+                        help="serial port name; can be given several times "
+                             "to program boards in parallel")
+    parser.add_argument("--all", action="store_true",
+                        help="program all boards with active bootloaders in "
+                             "parallel")
     parser.add_argument("-d", "--device", type=str, default="1209:2100",
                         help="device id (vendor:product); default is "
                              "TinyFPGA-B (1209:2100)")
-    parser.add_argument("-a", "--addr", type=int,
-                        help="force the address to write the bitstream to")
+    parser.add_argument("-a", "--addr", type=_number,
+                        help="force the address to write the bitstream to, "
+                             "or the address to --dump from")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the flash erase plan for --program or "
+                             "--manifest without touching any board")
+    parser.add_argument("--diff", action="store_true",
+                        help="only erase and write the flash sectors that "
+                             "differ from the bitstream")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="erase, write and verify one 64k block at a "
+                             "time instead of the whole range per phase")
+    parser.add_argument("--cache", action="store_true",
+                        help="remember verified flash contents per board "
+                             "serial number to skip unneeded readbacks")
+    parser.add_argument("--resume", action="store_true",
+                        help="program block by block and keep a journal of "
+                             "verified sectors per board, so a run that was "
+                             "interrupted continues where it stopped")
+    parser.add_argument("--events", type=str,
+                        help="write programming events (phases, progress, "
+                             "retries, latencies) as JSON lines to this "
+                             "file, - for stdout and the other output to "
+                             "stderr")
+    parser.add_argument("-w", "--window", type=int, default=1,
+                        help="maximum number of SPI commands sent per USB "
+                             "transfer; default is 1")
+    parser.add_argument("--read-size", type=int, default=16,
+                        help="maximum number of bytes per flash read; the "
+                             "stock bootloader only supports 16 (default)")
+    parser.add_argument("--write-size", type=int, default=16,
+                        help="maximum number of bytes per page program, up "
+                             "to 256; the stock bootloader only supports 16 "
+                             "(default)")
+    parser.add_argument("--tune", action="store_true",
+                        help="find the fastest baud rate, transfer sizes and "
+                             "window for each board's link and remember "
+                             "them for the next runs; overrides -w, "
+                             "--read-size and --write-size")
+    parser.add_argument("--trace", type=str,
+                        help="record every serial port call to the board "
+                             "in this file, for python -m tinyfpgab.trace")
+    parser.add_argument("--force", action="store_true",
+                        help="program bitstreams that are broken or not for "
+                             "the board's iCE40, and keep their padding")
 
     args = parser.parse_args()
 
+    # with the dump or the events going to stdout, everything else goes to
+    # stderr
+    events_out = sys.stdout
+    data_out = getattr(sys.stdout, 'buffer', sys.stdout)
+    if args.dump == '-' or args.events == '-':
+        sys.stdout = sys.stderr
+
     print("")
     print("    TinyFPGA B-series Programmer CLI")
     print("    --------------------------------")
@@ -35,73 +125,467 @@ def _main():
         print("    Invalid device id, use format vendor:product")
         sys.exit(1)
     device = '{}:{}'.format(device[:4], device[4:])
+    if args.window < 1:
+        print("    Invalid window size: {}".format(args.window))
+        sys.exit(1)
+    if not 0 < args.read_size < 0xffff:
+        print("    Invalid read size: {}".format(args.read_size))
+        sys.exit(1)
+    if not 0 < args.write_size <= 256:
+        print("    Invalid write size: {}".format(args.write_size))
+        sys.exit(1)
+
+    regions = []
+    if args.make_delta is not None and (
+            args.program is None or args.base is None or
+            not args.make_delta.endswith(('.delta', '.delta.gz'))):
+        print("    --make-delta needs --program, --base and a .delta or "
+              ".delta.gz file name")
+        sys.exit(1)
+    if sum(option is not None
+           for option in (args.program, args.manifest, args.dump)) > 1:
+        print("    Use only one of --program, --manifest and --dump")
+        sys.exit(1)
+    if (args.checksum or args.sparse or args.length is not None) and \
+            args.dump is None:
+        print("    --checksum, --sparse and --length need --dump")
+        sys.exit(1)
+    if args.sparse and (args.checksum or args.dump == '-'):
+        print("    --sparse needs a manifest file name and no --checksum")
+        sys.exit(1)
+    if args.dump is not None:
+        dump_addr = 0 if args.addr is None else args.addr
+        dump_length = FLASH_SIZE - dump_addr if args.length is None \
+            else args.length
+        if dump_addr < 0 or dump_length < 0 or \
+                dump_addr + dump_length > FLASH_SIZE:
+            print("    Dump range outside of the flash: {:06x}+{:x}".format(
+                dump_addr, dump_length))
+            sys.exit(1)
+    if args.program is not None:
+        if args.make_delta is not None:
+            _make_delta(args.program, args.base, args.make_delta)
+            sys.exit(0)
+        (addr, bitstream) = TinyFPGAB(None).slurp(args.program, args.base)
+        bitstream = _check_image(args.program, bitstream, args.force)
+        if args.addr is not None:
+            addr = args.addr
+        if addr < 0:
+            print("    Negative write addr: {}".format(addr))
+            sys.exit(1)
+        if addr + len(bitstream) > FLASH_SIZE:
+            print("    Bitstream at addr {:06x} ends past the {:06x} byte "
+                  "flash".format(addr, FLASH_SIZE))
+            sys.exit(1)
+        regions = [(addr, bitstream)]
+    elif args.manifest is not None:
+        try:
+            images = manifest.load(args.manifest)
+        except (IOError, OSError, ValueError) as e:
+            print("    {}".format(e))
+            sys.exit(1)
+        for image in images:
+            print("    {} bytes at addr {:06x} from {}".format(
+                len(image.data), image.addr, image.filename))
+        regions = [(image.addr, _check_image(image.filename, image.data,
+                                             args.force))
+                   for image in images]
+    elif args.dry_run:
+        print("    Nothing to plan, use --dry-run with --program")
+        sys.exit(1)
+
+    if args.dry_run:
+        fpga = TinyFPGAB(None, write_size=args.write_size)
+        operations = 0
+        estimated_time = 0
+        for group in group_regions(regions):
+            addr = group[0][0]
+            length = group[-1][0] + len(group[-1][1]) - addr
+            plan = fpga.plan_erase(addr, length)
+            print("    Programming {} bytes at addr {:06x} would take:"
+                  .format(length, addr))
+            for opcode, erase_addr, erase_length in plan.ops:
+                print("        erase {:2}k at {:06x} (opcode {:02x})".format(
+                    erase_length // 1024, erase_addr, opcode))
+            for restore_addr, restore_length in plan.preserve:
+                print("        preserve {} bytes at {:06x}".format(
+                    restore_length, restore_addr))
+            operations += len(plan)
+            estimated_time += plan.estimated_time
+        print("    {} erase operations, about {:.2f}s of flash busy time"
+              .format(operations, estimated_time))
+        sys.exit(0)
+
     print("    Using device id {}".format(device))
-    active_boards = [p[0] for p in comports() if device in p[2].lower()]
+    ports = list(comports())
+    active_boards = [p[0] for p in ports if device in p[2].lower()]
 
-    # find port to use
-    active_port = None
-    if args.com is not None:
-        active_port = args.com
+    # find ports to use
+    active_ports = []
+    if args.com:
+        active_ports = args.com
     elif not active_boards:
         print("    No port was specified and no active bootloaders found.")
         print("    Activate bootloader by pressing the reset button.")
         sys.exit(1)
     elif len(active_boards) == 1:
         print("    Only one board with active bootloader, using it.")
-        active_port = active_boards[0]
+        active_ports = active_boards
+    elif args.all:
+        print("    Using all {} boards with active bootloaders."
+              .format(len(active_boards)))
+        active_ports = active_boards
     else:
-        print("    Please choose a board with the -c option.")
-
-    # list boards
-    if args.list or active_port is None:
-        print("    Boards with active bootloaders:")
-        for p in active_boards:
-            print("        " + p)
-        if len(active_boards) == 0:
-            print("       No active bootloaders found.  Check USB connections")
-            print("       and press reset button to activate bootloader.")
-
-    # program the flash memory
-    elif args.program is not None:
-        print("    Programming " + active_port + " with " + args.program)
-
-        def progress(info):
-            if isinstance(info, str):
+        print("    Please choose a board with the -c option or use --all.")
+
+    # open ports, kept for booting boards that failed to program
+    sessions = {}
+    profiles = link.ProfileCache() if args.tune else None
+
+    def serial_number_of(port):
+        serial_numbers = [getattr(p, 'serial_number', None)
+                          for p in ports if p[0] == port]
+        return serial_numbers[0] if serial_numbers else None
+
+    def link_options(port, say):
+        # Session arguments for the port and, with --tune, the key of the
+        # link profile they come from
+        options = dict(window=args.window, read_size=args.read_size,
+                       write_size=args.write_size)
+        if profiles is None:
+            return options, None
+        key = '{}/{}'.format(device, serial_number_of(port) or port)
+        profile = profiles.get(key)
+        if profile is None:
+            say("Tuning the link to " + port)
+            profile = link.calibrate(
+                port, link.transport(device),
+                progress=lambda info: say("    " + info))
+            if profile is None:
+                say("Could not tune the link, using the default settings")
+                return options, None
+            profiles.put(key, profile)
+        say("Using the {} link at {} baud, read size {}, write size {}, "
+            "window {}".format(profile.transport, profile.baudrate,
+                               profile.read_size, profile.write_size,
+                               profile.window))
+        options = dict(window=profile.window, read_size=profile.read_size,
+                       write_size=profile.write_size,
+                       opener=functools.partial(
+                           open_serial, baudrate=profile.baudrate,
+                           timeout=profile.timeout))
+        return options, key
+
+    # opened with the first port
+    trace_files = []
+
+    def traced(options):
+        # Session arguments recording the port with --trace
+        if args.trace is None:
+            return options
+        opener = options.get('opener', open_serial)
+
+        def open_traced(port):
+            if not trace_files:
+                trace_files.append(open(args.trace, 'wb'))
+            return TraceRecorder(opener(port), trace_files[0])
+
+        options['opener'] = open_traced
+        return options
+
+    if args.trace is not None and len(active_ports) > 1:
+        print("    Trace one board at a time, choose it with -c")
+        sys.exit(1)
+
+    # the trace and events files are closed however the run ends
+    events = None
+    try:
+        # list boards
+        if args.list or not active_ports:
+            print("    Boards with active bootloaders:")
+            for p in active_boards:
+                print("        " + p)
+            if len(active_boards) == 0:
+                print("       No active bootloaders found.  Check USB "
+                      "connections")
+                print("       and press reset button to activate "
+                      "bootloader.")
+
+        # read the flash memory
+        elif args.dump is not None:
+            if len(active_ports) > 1:
+                print("    Dump one board at a time, choose it with -c")
+                sys.exit(1)
+            port = active_ports[0]
+
+            def say(info):
                 print("    " + info)
 
-        for attempt in range(3):
-            with serial.Serial(active_port, 115200, timeout=0.2,
-                               writeTimeout=0.2) as ser:
-                fpga = TinyFPGAB(ser, progress)
-                (addr, bitstream) = fpga.slurp(args.program)
-                if args.addr is not None:
-                    addr = args.addr
-                if addr < 0:
-                    print("    Negative write addr: {}".format(addr))
-                    sys.exit(1)
-                if addr + len(bitstream) >= 0x400000:
-                    print("    Write addr over 4Mio: {}".format(addr))
-                    sys.exit(1)
-                fpga.is_bootloader_active()
-                if not fpga.is_bootloader_active():
-                    print("    Bootloader not active")
-                    continue
-                print("    Programming at addr {:06x}".format(addr))
-                if fpga.program_bitstream(addr, bitstream):
-                    sys.exit(0)
-                else:
-                    continue
-
-    # boot the FPGA
-    if args.boot:
-        print("    Booting " + active_port)
-        with serial.Serial(active_port, 115200, timeout=0.2,
-                           writeTimeout=0.2) as ser:
-            fpga = TinyFPGAB(ser)
-            fpga.boot()
-    elif args.program is not None:
-        # exit with error if programming is not successful
+            options, _ = link_options(port, say)
+            options.pop('write_size')
+            session = sessions[port] = Session(port, **traced(options))
+            if not session.detect():
+                print("    Bootloader not active")
+                sys.exit(1)
+            print("    Reading {} bytes at addr {:06x} from {}".format(
+                dump_length, dump_addr, port))
+            try:
+                digest = _dump(session.fpga, dump_addr, dump_length, args,
+                               data_out)
+            except IOError as e:
+                print("    Error: {}".format(e))
+                sys.exit(1)
+            print("    SHA-256 {}".format(digest))
+
+        # program the flash memory
+        elif regions:
+            output_lock = threading.Lock()
+            if args.events == '-':
+                events = events_out
+            elif args.events is not None:
+                events = open(args.events, 'w')
+
+            def output(port, info):
+                with output_lock:
+                    if len(active_ports) > 1:
+                        print("    {}: {}".format(port, info))
+                    else:
+                        print("    " + info)
+
+            def program_board(port):
+                output(port, "Programming " + port + " with " +
+                       (args.program or args.manifest))
+
+                def progress(info):
+                    if isinstance(info, str):
+                        output(port, info)
+
+                def listener(event):
+                    if event['event'] == 'phase_end' and event['seconds']:
+                        output(port, "    {} bytes {} in {:.2f}s, {:.1f} kB/s"
+                               .format(event['bytes'], event['phase'],
+                                       event['seconds'],
+                                       event['rate'] / 1000.0))
+                    if events is not None:
+                        event['port'] = port
+                        with output_lock:
+                            events.write(json.dumps(event) + '\n')
+                            events.flush()
+
+                serial_number = serial_number_of(port)
+                cache = None
+                if args.cache:
+                    if serial_number:
+                        cache = FlashCache(serial_number)
+                    else:
+                        output(port, "No USB serial number for " + port +
+                               ", not using the cache")
+
+                # retries only redo what was not verified yet, and with
+                # --resume neither does the next run
+                journal_path = None
+                if args.resume:
+                    journal_path = journal.default_path(serial_number or port)
+                board_journal = journal.Journal(regions, journal_path)
+                pipelined = args.pipelined or args.resume
+
+                # the port stays open across attempts, it is only reopened
+                # after an error on it
+                options, profile_key = link_options(
+                    port, lambda info: output(port, info))
+                session = sessions[port] = Session(
+                    port, progress=progress, cache=cache,
+                    journal=board_journal, **traced(options))
+                attempts = 5 if args.resume else 3
+                for attempt in range(attempts):
+                    if attempt:
+                        # give a board that dropped off the bus time to return
+                        time.sleep(min(0.5 * 2 ** (attempt - 1), 4))
+                    try:
+                        if not session.detect():
+                            output(port, "Bootloader not active")
+                            session.reset()
+                            continue
+                        fpga = session.fpga
+                        fpga.telemetry = Telemetry(listener)
+                        if args.manifest is not None:
+                            success = fpga.program_images(regions, args.diff,
+                                                          pipelined)
+                        else:
+                            output(port, "Programming at addr {:06x}".format(
+                                addr))
+                            success = fpga.program_bitstream(
+                                addr, bitstream, args.diff, pipelined)
+                    except serial.SerialException as e:
+                        output(port, "Error: {}".format(e))
+                        session.reset()
+                        continue
+                    if success:
+                        # the board booted, its port is gone
+                        session.close()
+                        return True
+                if profile_key is not None:
+                    # the write size was never tried, tune again next time
+                    output(port, "Forgetting the tuned link profile")
+                    profiles.forget(profile_key)
+                return False
+
+            results = {}
+
+            def run(port):
+                try:
+                    results[port] = program_board(port)
+                except serial.SerialException as e:
+                    output(port, "Error: {}".format(e))
+                    results[port] = False
+
+            # one thread per board, each with its own serial port
+            threads = [threading.Thread(target=run, args=(port,))
+                       for port in active_ports]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            failed = [port for port in active_ports if not results.get(port)]
+            if len(active_ports) > 1:
+                print("    {} of {} boards programmed successfully".format(
+                    len(active_ports) - len(failed), len(active_ports)))
+                for port in failed:
+                    print("        Failed: " + port)
+            if not failed:
+                sys.exit(0)
+            # only the boards that failed are left in the bootloader
+            active_ports = failed
+
+        # boot the FPGA
+        if args.boot:
+            for port in active_ports:
+                print("    Booting " + port)
+                # reuse the port left open by programming, if any
+                sessions.get(port, Session(port)).boot()
+        if regions:
+            # exit with error if programming is not successful
+            sys.exit(1)
+    finally:
+        for f in trace_files:
+            f.close()
+        if events is not None and events is not events_out:
+            events.close()
+
+
+def _number(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        return int(text, 10)
+
+
+def _check_image(filename, data, force):
+    # fail before touching any board on a bitstream that can't work, and
+    # leave out its padding
+    from tinyfpgab import ice40
+
+    if force:
+        return data
+    try:
+        trimmed = ice40.check(data)
+    except ValueError as e:
+        print("    {}: {}".format(filename, e))
+        print("    Use --force to program it anyway")
         sys.exit(1)
+    if len(trimmed) < len(data):
+        print("    Leaving out {} bytes of padding at the end of {}".format(
+            len(data) - len(trimmed), filename))
+    return trimmed
+
+
+def _make_delta(filename, base, delta):
+    import gzip
+    from tinyfpgab import TinyFPGAB, xor_delta
+
+    fpga = TinyFPGAB(None)
+    opener = gzip.open if delta.endswith('.gz') else open
+    length = 0
+    with opener(delta, 'wb') as f:
+        for chunk in xor_delta(fpga.stream(base), fpga.stream(filename)):
+            f.write(chunk)
+            length += len(chunk)
+    print("    Wrote {} byte delta of {} to {}".format(
+        length, filename, delta))
+
+
+def _dump(fpga, addr, length, args, data_out):
+    # write the flash contents, their sector checksums or, for --sparse,
+    # the non-erased parts in separate files and a manifest listing them
+    # to args.dump; returns the SHA-256 of the range
+    from tinyfpgab import erased_ranges
+
+    if args.dump == '-':
+        out = data_out
+    else:
+        out = open(args.dump, 'wb')
+    digest = hashlib.sha256()
+    erased = []
+    regions = []
+    part = None
+    try:
+        for chunk_addr, chunk in fpga.dump(addr, length):
+            digest.update(chunk)
+            chunk_end = chunk_addr + len(chunk)
+            if args.checksum:
+                sector_addr = chunk_addr
+                while sector_addr < chunk_end:
+                    sector_end = min((sector_addr & ~0xfff) + 0x1000,
+                                     chunk_end)
+                    sector = chunk[sector_addr - chunk_addr:
+                                   sector_end - chunk_addr]
+                    line = "{:06x} {}\n".format(
+                        sector_addr, hashlib.sha256(sector).hexdigest())
+                    out.write(line.encode('ascii'))
+                    sector_addr = sector_end
+            elif args.sparse:
+                start = chunk_addr
+                for erased_start, erased_end in erased_ranges(
+                        chunk_addr, chunk) + [(chunk_end, chunk_end)]:
+                    if start < erased_start:
+                        if part is None or part_end != start:
+                            if part is not None:
+                                part.close()
+                            filename = '{}-{:06x}.bin'.format(
+                                os.path.splitext(args.dump)[0], start)
+                            part = open(filename, 'wb')
+                            regions.append({
+                                'file': os.path.basename(filename),
+                                'addr': '0x{:06x}'.format(start)})
+                        part.write(chunk[start - chunk_addr:
+                                         erased_start - chunk_addr])
+                        part_end = erased_start
+                    if erased_start < erased_end:
+                        if erased and erased[-1][1] == erased_start:
+                            erased[-1] = (erased[-1][0], erased_end)
+                        else:
+                            erased.append((erased_start, erased_end))
+                    start = erased_end
+            else:
+                out.write(chunk)
+            print("    Read {} of {} bytes".format(chunk_end - addr, length))
+        if args.checksum:
+            out.write("{:06x}-{:06x} {}\n".format(
+                addr, addr + length, digest.hexdigest()).encode('ascii'))
+        if args.sparse:
+            out.write((json.dumps({'regions': regions}, indent=2) + '\n')
+                      .encode('ascii'))
+            for start, end in erased:
+                print("    Erased {:06x}-{:06x}".format(start, end))
+    finally:
+        if part is not None:
+            part.close()
+        if out is data_out:
+            out.flush()
+        else:
+            out.close()
+    return digest.hexdigest()
 
 
 def main():
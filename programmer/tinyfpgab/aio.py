@@ -0,0 +1,263 @@
+import asyncio
+
+from tinyfpgab import FlashTiming, TinyFPGAB, program_plan
+
+# Python 3 only: asyncio variant of the TinyFPGAB command layer
+
+
+class AsyncTinyFPGAB(object):
+    # talks to the bootloader over an asyncio (reader, writer) stream pair,
+    # e.g. from serial_asyncio.open_serial_connection(), so that one event
+    # loop can program many boards.  framing, read/write chunking, erase
+    # planning and flash timing are shared with TinyFPGAB.  every response
+    # has to arrive within `timeout` seconds or asyncio.TimeoutError is
+    # raised.  the answer to a timed out or cancelled transfer is skipped
+    # by the next one, so the board can still be used afterwards.  what to
+    # erase, write, verify and rewrite is planned by the same code as for
+    # TinyFPGAB, only the I/O is done here.
+    _frame = staticmethod(TinyFPGAB._frame)
+    _read_commands = TinyFPGAB._read_commands
+    _write_chunks = TinyFPGAB._write_chunks
+    _done = TinyFPGAB._done
+    _phase = TinyFPGAB._phase
+    _diff_summary = TinyFPGAB._diff_summary
+    _rewrites = TinyFPGAB._rewrites
+    _rewritten = TinyFPGAB._rewritten
+    _retry_delay = TinyFPGAB._retry_delay
+    _verified = TinyFPGAB._verified
+    plan_erase = TinyFPGAB.plan_erase
+    RETRY_DELAY = TinyFPGAB.RETRY_DELAY
+    MAX_RETRY_DELAY = TinyFPGAB.MAX_RETRY_DELAY
+    journal = None
+
+    def __init__(self, reader, writer, progress=None, window=1, read_size=16,
+                 write_size=16, timing=None, telemetry=None, timeout=0.2,
+                 delay=asyncio.sleep):
+        if not 0 < read_size < 0xffff:
+            raise ValueError('Invalid read size: {}'.format(read_size))
+        if not 0 < write_size <= 256:
+            raise ValueError('Invalid write size: {}'.format(write_size))
+        self.reader = reader
+        self.writer = writer
+        self.window = window
+        self.read_size = read_size
+        self.write_size = write_size
+        self.timing = FlashTiming() if timing is None else timing
+        self.telemetry = telemetry
+        self.timeout = timeout
+        self.stale = 0
+        # coroutine function used for every wait, timing.sleep is not
+        self.delay = delay
+        if progress is None:
+            self.progress = lambda x: x
+        else:
+            self.progress = progress
+
+    async def _transfer(self, frames, read_len):
+        self.writer.write(bytes(frames))
+        await self.writer.drain()
+        if not read_len:
+            return b''
+        # readexactly() consumes nothing when cancelled, so whatever is
+        # still owed from an abandoned transfer arrives before our answer
+        self.stale += read_len
+        data = await asyncio.wait_for(
+            self.reader.readexactly(self.stale), self.timeout)
+        self.stale = 0
+        return data[-read_len:]
+
+    async def cmd(self, opcode, addr=None, data=b'', read_len=0):
+        return (await self.cmds([(opcode, addr, data, read_len)]))[0]
+
+    async def cmds(self, commands):
+        # same batching as TinyFPGAB.cmds
+        commands = list(commands)
+        responses = []
+        telemetry = self.telemetry
+        for i in range(0, len(commands), self.window):
+            batch = commands[i:i + self.window]
+            frames = bytearray()
+            for command in batch:
+                frames += self._frame(*command)
+            if telemetry is not None:
+                started = telemetry.timer()
+            data = await self._transfer(frames, sum(c[3] for c in batch))
+            if telemetry is not None:
+                telemetry.command(batch[-1][0], telemetry.timer() - started,
+                                  len(batch))
+            offset = 0
+            for command in batch:
+                responses.append(data[offset:offset + command[3]])
+                offset += command[3]
+        return responses
+
+    async def is_bootloader_active(self, attempts=6):
+        for i in range(attempts):
+            await self.wake()
+            await self.read(0, 16)
+            await self.wake()
+            if await self.read_id() == b'\x1f\x84\x01':
+                return True
+            await self.delay(0.05)
+        return False
+
+    async def sleep(self):
+        await self.cmd(0xb9)
+
+    async def wake(self):
+        await self.cmd(0xab)
+
+    async def read_id(self):
+        return await self.cmd(0x9f, read_len=3)
+
+    async def read_sts(self):
+        return await self.cmd(0x05, read_len=1) or b'\x01'
+
+    async def _read_ranges(self, ranges):
+        # same in place filling as TinyFPGAB._read_ranges
+        commands = self._read_commands(ranges)
+        data = [bytearray(length) for _, length in ranges]
+        filled = [0] * len(ranges)
+        for i in range(0, len(commands), self.window):
+            batch = commands[i:i + self.window]
+            responses = await self.cmds(command for _, command in batch)
+            for (index, _), response in zip(batch, responses):
+                data[index][filled[index]:filled[index] + len(response)] = \
+                    response
+                filled[index] += len(response)
+                self._done(len(response))
+        return [buf if length == len(buf) else buf[:length]
+                for buf, length in zip(data, filled)]
+
+    async def read(self, addr, length):
+        return (await self._read_ranges([(addr, length)]))[0]
+
+    async def wait_while_busy(self):
+        timing = self.timing
+        await self.delay(timing.first_poll_delay())
+        while True:
+            polled = timing.timer()
+            if not ord(await self.read_sts()) & 1:
+                break
+            if self.telemetry is not None:
+                self.telemetry.busy_poll()
+            timing.busy_at(polled)
+            await self.delay(timing.poll_interval())
+        timing.done(polled)
+
+    async def erase(self, addr, length):
+        plan = self.plan_erase(addr, length)
+        restore_data = await self._read_ranges(plan.preserve)
+        for opcode, erase_addr, erase_length in plan.ops:
+            self._done(erase_length)
+            await self.cmds([(0x06, None, b'', 0),
+                             (opcode, erase_addr, b'', 0)])
+            self.timing.start(opcode)
+            await self.wait_while_busy()
+        for (restore_addr, _), data in zip(plan.preserve, restore_data):
+            await self.write(restore_addr, data)
+
+    async def write(self, addr, data):
+        for chunk_addr, chunk in self._write_chunks(addr, data):
+            await self.cmds([(0x06, None, b'', 0),
+                             (0x02, chunk_addr, chunk, 0)])
+            self.timing.start(0x02)
+            await self.wait_while_busy()
+            self._done(len(chunk))
+
+    async def _verify(self, addr, data):
+        read_back = await self.read(addr, len(data))
+        for page_addr, page_data in self._rewrites(addr, data, read_back):
+            self.progress("rewriting page {:06x}".format(page_addr))
+            for attempt in range(6):
+                await self.erase(page_addr, len(page_data))
+                await self.write(page_addr, page_data)
+                if self._rewritten(page_addr, page_data,
+                                   await self.read(page_addr, len(page_data)),
+                                   attempt):
+                    break
+                await self.delay(self._retry_delay(attempt))
+            else:
+                return False
+        return True
+
+    async def program(self, addr, data, diff=False):
+        try:
+            current = None
+            if diff:
+                self._phase('compare', len(data))
+                self.progress("Reading current flash contents")
+                current = await self.read(addr, len(data))
+            erase_ranges, writes, unchanged = program_plan(addr, data,
+                                                           current)
+            if diff:
+                self._diff_summary(erase_ranges, writes, unchanged)
+
+            if erase_ranges:
+                self._phase('erase', sum(stop - start
+                                         for start, stop in erase_ranges))
+                self.progress("Erasing designated flash pages")
+                for start, stop in erase_ranges:
+                    await self.erase(start, stop - start)
+
+            self._phase('write', sum(len(chunk) for _, chunk in writes))
+            self.progress("Writing bitstream")
+            for start, chunk in writes:
+                await self.write(start, chunk)
+
+            self._phase('verify', sum(len(chunk) for _, chunk in writes))
+            self.progress("Verifying bitstream")
+            success = True
+            for start, chunk in writes:
+                if not await self._verify(start, chunk):
+                    success = False
+                    break
+        finally:
+            self._phase(None)
+        if not success:
+            self.progress("Verification Failed!")
+            return False
+        self.progress("Success!")
+        return True
+
+    async def boot(self):
+        self.writer.write(b'\x00')
+        await self.writer.drain()
+
+    async def program_bitstream(self, addr, bitstream, diff=False):
+        self.progress("Waking up SPI flash")
+        self.progress(str(len(bitstream)) + " bytes to program")
+        if await self.program(addr, bitstream, diff):
+            await self.boot()
+            return True
+        return False
+
+
+async def open_serial(port, **kwargs):
+    # needs the pyserial-asyncio package
+    import serial_asyncio
+    reader, writer = await serial_asyncio.open_serial_connection(
+        url=port, baudrate=115200)
+    return AsyncTinyFPGAB(reader, writer, **kwargs)
+
+
+class SimulatedStreams(object):
+    # (reader, writer) pair in front of a sim.SimulatedBootloader, which
+    # must not sleep on a real clock
+    def __init__(self, bootloader):
+        self.bootloader = bootloader
+        self.reader = asyncio.StreamReader()
+
+    def write(self, data):
+        self.bootloader.write(data)
+        response = self.bootloader.read(self.bootloader.in_waiting)
+        if response:
+            self.reader.feed_data(response)
+
+    async def drain(self):
+        self.bootloader.flush()
+        # let other boards run, like a real USB round trip would
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.bootloader.close()
@@ -0,0 +1,175 @@
+import collections
+import json
+import random
+import struct
+import sys
+import time
+
+from tinyfpgab import FlashTiming, Telemetry, TinyFPGAB, USER_ADDR
+from tinyfpgab import check_range
+from tinyfpgab.sim import SimulatedBootloader, SimulatedFlash, VirtualClock
+
+ERASE_OPCODES = (0x20, 0x52, 0xd8)
+
+
+class SerialCounter(object):
+    # wraps a serial port to count what goes over it, attributed to the
+    # phase of programming the telemetry says is running
+    def __init__(self, ser, telemetry):
+        self.ser = ser
+        self.telemetry = telemetry
+        self.phases = collections.defaultdict(collections.Counter)
+
+    def write(self, data):
+        stats = self.phases[self.telemetry.current]
+        stats['transfers'] += 1
+        offset = 0
+        while offset + 5 < len(data) and data[offset] == 0x01:
+            write_len = struct.unpack('<H', bytes(data[offset + 1:
+                                                       offset + 3]))[0]
+            opcode = data[offset + 5]
+            if opcode == 0x05:
+                stats['status_polls'] += 1
+            elif opcode in ERASE_OPCODES:
+                stats['erase_ops'] += 1
+            elif opcode == 0x02:
+                stats['page_programs'] += 1
+            offset += 5 + write_len
+        return self.ser.write(data)
+
+    def flush(self):
+        return self.ser.flush()
+
+    def read(self, size=1):
+        if size:
+            self.phases[self.telemetry.current]['round_trips'] += 1
+        return self.ser.read(size)
+
+
+def run(ser, size, addr, read_size=16, write_size=16, window=1, mode='normal',
+        timing=None, timer=time.time, seed=0):
+    data = bytes(bytearray(
+        random.Random(seed).randrange(256) for _ in range(size)))
+    telemetry = Telemetry(timer=timer)
+    counter = SerialCounter(ser, telemetry)
+    fpga = TinyFPGAB(counter, window=window, read_size=read_size,
+                     write_size=write_size, timing=timing,
+                     telemetry=telemetry)
+    started = timer()
+    success = fpga.program(addr, data, diff=(mode == 'diff'),
+                           pipelined=(mode == 'pipelined'))
+    seconds = timer() - started
+    phases = collections.OrderedDict()
+    for name, stats in telemetry.phases.items():
+        if name != 'idle':
+            phases[name] = dict(stats, **counter.phases[name])
+    return {
+        'size': size,
+        'addr': addr,
+        'read_size': read_size,
+        'write_size': write_size,
+        'window': window,
+        'mode': mode,
+        'success': success,
+        'seconds': seconds,
+        'bytes_per_second': size / seconds if seconds else None,
+        'phases': phases,
+    }
+
+
+def run_simulated(size, addr, latency=0.001, seed=0, **kwargs):
+    clock = VirtualClock()
+    flash = SimulatedFlash(clock=clock, seed=seed)
+    bootloader = SimulatedBootloader(flash, latency=latency, clock=clock)
+    timing = FlashTiming(sleep=clock.sleep, timer=clock.time)
+    return run(bootloader, size, addr, timing=timing, timer=clock.time,
+               seed=seed, **kwargs)
+
+
+def _ints(text):
+    return [int(i, 0) for i in text.split(',')]
+
+
+def main(argv=None):
+    import argparse
+    import itertools
+
+    parser = argparse.ArgumentParser(
+        description="measure TinyFPGA B-series programming throughput")
+    parser.add_argument("-c", "--com", type=str,
+                        help="serial port of a real board; the default is to "
+                             "use the simulated bootloader")
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="simulated seconds per USB round trip")
+    parser.add_argument("--sizes", type=_ints, default=[32768, 135100],
+                        help="comma separated bitstream sizes")
+    parser.add_argument("--addrs", type=_ints, default=[0x30000, 0x30010],
+                        help="comma separated flash addresses")
+    parser.add_argument("--read-sizes", type=_ints, default=[16])
+    parser.add_argument("--write-sizes", type=_ints, default=[16])
+    parser.add_argument("--windows", type=_ints, default=[1])
+    parser.add_argument("--modes", type=lambda t: t.split(','),
+                        default=['normal'],
+                        help="comma separated: normal, diff, pipelined")
+    parser.add_argument("--json", type=str,
+                        help="write one JSON result per line to this file, "
+                             "- for stdout")
+    args = parser.parse_args(argv)
+
+    # the bootloader below USER_ADDR must survive a benchmark
+    for size, addr in itertools.product(args.sizes, args.addrs):
+        try:
+            check_range(addr, size, USER_ADDR)
+        except ValueError as e:
+            print(e)
+            return 1
+    session = None
+    if args.com is not None:
+        from tinyfpgab.session import Session
+        session = Session(args.com)
+        if not session.detect():
+            print("Bootloader not active on " + args.com)
+            session.close()
+            return 1
+
+    results = []
+    for size, addr, read_size, write_size, window, mode in itertools.product(
+            args.sizes, args.addrs, args.read_sizes, args.write_sizes,
+            args.windows, args.modes):
+        kwargs = dict(read_size=read_size, write_size=write_size,
+                      window=window, mode=mode)
+        if session is None:
+            result = run_simulated(size, addr, args.latency, **kwargs)
+        else:
+            result = run(session.ser, size, addr, **kwargs)
+        results.append(result)
+        if args.json != '-':
+            print("{size:7} bytes at {addr:06x}, read {read_size}, write "
+                  "{write_size}, window {window}, {mode}: {seconds:.2f}s, "
+                  "{bytes_per_second:.0f} B/s{failed}".format(
+                      failed='' if result['success'] else ' FAILED',
+                      **result))
+            for name, stats in result['phases'].items():
+                print("    {:8} {:8.2f}s {:6} round trips {:6} polls "
+                      "{:4} erases {:3} retries".format(
+                          name, stats['seconds'],
+                          stats.get('round_trips', 0),
+                          stats.get('status_polls', 0),
+                          stats.get('erase_ops', 0),
+                          stats['retries']))
+
+    if args.json == '-':
+        for result in results:
+            print(json.dumps(result))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    if session is not None:
+        session.close()
+    return 0 if all(result['success'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# boards programmed in parallel share the cache file
+_save_lock = threading.Lock()
+
+
+def cache_path(name):
+    # a file in the user's cache directory for tinyfpgab
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tinyfpgab', name)
+
+
+def load_json(path):
+    # the object saved by save_json, empty when the file is missing or
+    # broken
+    try:
+        with open(path) as f:
+            value = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def save_json(path, value):
+    # written to a temporary file first and renamed, so that a crash or
+    # another programmer run never sees half a file
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def default_path():
+    return cache_path('flash.json')
+
+
+def _sector_ranges(addr, length):
+    # split a range at the 4k sector boundaries
+    end = addr + length
+    while addr < end:
+        sector_end = min((addr & ~0xfff) + 0x1000, end)
+        yield addr, sector_end
+        addr = sector_end
+
+
+class FlashCache(object):
+    # remembers the SHA-256 of flash ranges that were last verified on a
+    # given board (identified by its USB serial number).  ranges never cross
+    # a 4k sector boundary, so erasing or writing anywhere in a sector drops
+    # everything known about it.
+
+    def __init__(self, serial_number, path=None, max_boards=64,
+                 max_age=7 * 24 * 3600):
+        self.serial_number = serial_number
+        self.path = default_path() if path is None else path
+        self.max_boards = max_boards
+        self.max_age = max_age
+        self.boards = self._load()
+        board = self.boards.get(serial_number)
+        if board is None or time.time() - board['used'] > max_age:
+            board = {'used': time.time(), 'sectors': {}}
+        self.sectors = board['sectors']
+
+    def _load(self):
+        return load_json(self.path).get('boards', {})
+
+    def save(self):
+        with _save_lock:
+            # merge with what other programmer runs saved in the meantime
+            self.boards = self._load()
+            self.boards[self.serial_number] = {
+                'used': time.time(),
+                'sectors': self.sectors,
+            }
+            # evict the least recently used boards
+            for serial_number in sorted(
+                    self.boards, key=lambda s: self.boards[s]['used'],
+                    reverse=True)[self.max_boards:]:
+                del self.boards[serial_number]
+            save_json(self.path, {'boards': self.boards})
+
+    @staticmethod
+    def _key(start, end):
+        return '{:06x}-{:06x}'.format(start, end)
+
+    def matches(self, addr, data):
+        # True if every sector of the range is known to hold the data
+        for start, end in _sector_ranges(addr, len(data)):
+            digest = self.sectors.get(self._key(start, end))
+            if digest != hashlib.sha256(
+                    data[start - addr:end - addr]).hexdigest():
+                return False
+        return bool(data)
+
+    def store(self, addr, data):
+        for start, end in _sector_ranges(addr, len(data)):
+            self._drop(start)
+            self.sectors[self._key(start, end)] = hashlib.sha256(
+                data[start - addr:end - addr]).hexdigest()
+        self.save()
+
+    def _drop(self, sector_addr):
+        prefix = sector_addr >> 12
+        dropped = False
+        for key in list(self.sectors):
+            if int(key[:6], 16) >> 12 == prefix:
+                del self.sectors[key]
+                dropped = True
+        return dropped
+
+    def invalidate(self, addr=None, length=None):
+        if addr is None:
+            dropped = bool(self.sectors)
+            self.sectors = {}
+        else:
+            dropped = False
+            for start, end in _sector_ranges(addr, length):
+                dropped = self._drop(start) or dropped
+        # persist right away: a stale entry surviving an interrupted
+        # programming run would make the next run skip a broken sector
+        if dropped:
+            self.save()
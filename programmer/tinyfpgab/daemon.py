@@ -0,0 +1,365 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from tinyfpgab import check_range
+from tinyfpgab.cache import cache_path
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+# POSIX only: a programming service on a Unix socket.  the service watches
+# for boards with active bootloaders, opens and detects them the moment they
+# appear and keeps their ports open, so queued jobs start right away.  the
+# client side only needs the standard library.
+
+
+def default_path():
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'tinyfpgab.sock')
+    return cache_path('tinyfpgab.sock')
+
+
+def scan_ports(device):
+    # ports of the connected boards with the vendor:product device id
+    from serial.tools.list_ports import comports
+    return [p[0] for p in comports() if device in p[2].lower()]
+
+
+class Daemon(object):
+    # jobs are JSON objects with an "op" of "list", "program", "boot" or
+    # "dump"; the other ops wait up to "wait" seconds for a board (the one
+    # on "port" if given) and run one at a time per board.  scan returns
+    # the ports to watch, session_factory makes a session.Session for one.
+    # ports that fail detection, e.g. while udev still sets the permissions
+    # or the bootloader settles, are probed again after retry_interval
+    # seconds, doubling up to max_retry_interval.
+
+    def __init__(self, scan, session_factory, poll_interval=0.1,
+                 retry_interval=0.5, max_retry_interval=8.0):
+        self.scan = scan
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        # port -> Session of the boards with an active bootloader
+        self.sessions = {}
+        # port -> (time of the next probe, interval) of the ports without
+        # an active bootloader
+        self.inactive = {}
+        self.busy = set()
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+
+    def scan_once(self):
+        ports = set(self.scan())
+        now = time.time()
+        with self.condition:
+            for port in set(self.sessions) - ports - self.busy:
+                self.sessions.pop(port).close()
+            self.inactive = dict((port, retry)
+                                 for port, retry in self.inactive.items()
+                                 if port in ports)
+            new = sorted(port for port in ports - set(self.sessions)
+                         if self.inactive.get(port, (now, 0))[0] <= now)
+        for port in new:
+            session = self.session_factory(port)
+            try:
+                active = session.detect()
+            except (IOError, OSError):
+                active = False
+            if not active:
+                session.close()
+                with self.condition:
+                    interval = self.retry_interval
+                    if port in self.inactive:
+                        interval = min(self.inactive[port][1] * 2,
+                                       self.max_retry_interval)
+                    self.inactive[port] = (time.time() + interval, interval)
+                continue
+            with self.condition:
+                self.inactive.pop(port, None)
+                self.sessions[port] = session
+                self.condition.notify_all()
+
+    def watch(self):
+        while not self.stopped.is_set():
+            self.scan_once()
+            self.stopped.wait(self.poll_interval)
+
+    def _acquire(self, port, wait):
+        deadline = time.time() + wait
+        with self.condition:
+            while True:
+                for p in [port] if port else sorted(self.sessions):
+                    if p in self.sessions and p not in self.busy:
+                        self.busy.add(p)
+                        return p, self.sessions[p]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError('No active bootloader{}'.format(
+                        ' on ' + port if port else ''))
+                self.condition.wait(remaining)
+
+    def _release(self, port, forget):
+        # forget the session of a board that booted or failed
+        with self.condition:
+            self.busy.discard(port)
+            if forget:
+                self.sessions.pop(port).close()
+            self.condition.notify_all()
+
+    def run(self, job, send):
+        # run a job, sending progress messages; returns the result
+        op = job.get('op')
+        if op == 'list':
+            with self.condition:
+                return {'ok': True, 'boards': sorted(self.sessions),
+                        'busy': sorted(self.busy)}
+        if op not in ('program', 'boot', 'dump'):
+            raise ValueError('Unknown op: {}'.format(op))
+        # bad jobs fail before taking a board
+        if op == 'program':
+            image = self._image(job)
+        elif op == 'dump':
+            check_range(job.get('addr', 0), job['length'])
+        port, session = self._acquire(job.get('port'), job.get('wait', 0))
+        forget = True
+        try:
+            fpga = session.fpga
+
+            def progress(info):
+                if isinstance(info, str):
+                    send({'port': port, 'progress': info})
+
+            fpga.progress = progress
+            if op == 'program':
+                result, forget = self._program(fpga, job, *image)
+            elif op == 'boot':
+                fpga.boot()
+                result = {'ok': True}
+            else:
+                result = self._dump(fpga, job)
+                forget = False
+            result['port'] = port
+            return result
+        finally:
+            fpga.progress = lambda info: info
+            self._release(port, forget)
+
+    def _image(self, job):
+        # the address and data to program, which must leave the bootloader
+        # alone
+        from tinyfpgab import TinyFPGAB, USER_ADDR, ice40
+
+        addr, data = TinyFPGAB(None).slurp(job['file'], job.get('base'))
+        if job.get('addr') is not None:
+            addr = job['addr']
+        if not job.get('force'):
+            data = ice40.check(data)
+        check_range(addr, len(data), USER_ADDR)
+        return addr, data
+
+    def _program(self, fpga, job, addr, data):
+        # returns the result and whether the board booted
+        if job.get('boot', True):
+            success = fpga.program_bitstream(addr, data)
+            return {'ok': success}, success
+        return {'ok': fpga.program(addr, data)}, False
+
+    def _dump(self, fpga, job):
+        import hashlib
+
+        digest = hashlib.sha256()
+        with open(job['file'], 'wb') as f:
+            for _, chunk in fpga.dump(job.get('addr', 0), job['length']):
+                f.write(chunk)
+                digest.update(chunk)
+        return {'ok': True, 'sha256': digest.hexdigest()}
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        def send(message):
+            try:
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (IOError, OSError):
+                pass  # the client went away, the job goes on
+
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            result = self.server.daemon.run(job, send)
+        except Exception as e:
+            result = {'ok': False, 'error': str(e)}
+        send(result)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except (IOError, OSError):
+                # left behind by a service that didn't stop cleanly
+                os.remove(path)
+            else:
+                raise IOError('A service is already running on ' + path)
+            finally:
+                probe.close()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        self.daemon = daemon
+
+    def serve(self):
+        watcher = threading.Thread(target=self.daemon.watch)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            self.serve_forever()
+        finally:
+            self.daemon.stop()
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def request(job, path=None, progress=None):
+    # send a job to the service; progress gets every progress message,
+    # returns the final result
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(default_path() if path is None else path)
+    try:
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        replies = client.makefile('rb')
+        for line in replies:
+            message = json.loads(line.decode('utf-8'))
+            if 'progress' in message:
+                if progress is not None:
+                    progress(message)
+                continue
+            return message
+        raise IOError('The service closed the connection')
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    import argparse
+    from tinyfpgab import FLASH_SIZE
+
+    parser = argparse.ArgumentParser(
+        description="TinyFPGA B-series programming service and its client")
+    parser.add_argument("--socket", type=str, default=default_path(),
+                        help="Unix socket of the service")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser(
+        "serve", help="run the service, keeping boards with an active "
+                      "bootloader open as soon as they appear")
+    serve.add_argument("-d", "--device", type=str, default="1209:2100",
+                       help="device id (vendor:product) to watch for")
+    serve.add_argument("--poll", type=float, default=0.1,
+                       help="seconds between port scans")
+    serve.add_argument("-w", "--window", type=int, default=1)
+    serve.add_argument("--read-size", type=int, default=16)
+    serve.add_argument("--write-size", type=int, default=16)
+    program = commands.add_parser(
+        "program", help="program a bitstream and boot the board")
+    program.add_argument("file", type=str)
+    program.add_argument("-a", "--addr", type=lambda text: int(text, 0))
+    program.add_argument("--base", type=str,
+                         help="base bitstream of a .delta file")
+    program.add_argument("--no-boot", action="store_true",
+                         help="keep the board in the bootloader")
+    program.add_argument("--force", action="store_true",
+                         help="skip the bitstream checks")
+    boot = commands.add_parser("boot", help="boot a board")
+    dump = commands.add_parser("dump", help="read the flash into a file")
+    dump.add_argument("file", type=str)
+    dump.add_argument("-a", "--addr", type=lambda text: int(text, 0),
+                      default=0)
+    dump.add_argument("--length", type=lambda text: int(text, 0),
+                      default=FLASH_SIZE)
+    for command in (program, boot, dump):
+        command.add_argument("-c", "--com", type=str,
+                             help="serial port of the board; default is "
+                                  "the first one free")
+        command.add_argument("--wait", type=float, default=30,
+                             help="seconds to wait for a board")
+    commands.add_parser("list", help="list the boards held open")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.command == 'serve':
+        from tinyfpgab.session import Session
+
+        daemon = Daemon(
+            lambda: scan_ports(args.device.lower()),
+            lambda port: Session(port, window=args.window,
+                                 read_size=args.read_size,
+                                 write_size=args.write_size),
+            args.poll)
+        try:
+            server = Server(args.socket, daemon)
+        except (IOError, OSError) as e:
+            print(e)
+            return 1
+        print("Serving on " + args.socket)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    job = {'op': args.command}
+    if args.command == 'program':
+        job.update(file=os.path.abspath(args.file), addr=args.addr,
+                   boot=not args.no_boot, force=args.force)
+        if args.base is not None:
+            job['base'] = os.path.abspath(args.base)
+    elif args.command == 'dump':
+        job.update(file=os.path.abspath(args.file), addr=args.addr,
+                   length=args.length)
+    if args.command != 'list':
+        job.update(port=args.com, wait=args.wait)
+
+    def progress(message):
+        print(message['progress'])
+
+    try:
+        result = request(job, args.socket, progress)
+    except (IOError, OSError) as e:
+        print("No service on {} ({}), start one with the serve command"
+              .format(args.socket, e))
+        return 1
+    if args.command == 'list':
+        for port in result['boards']:
+            print(port + (" (busy)" if port in result['busy'] else ""))
+    elif 'error' in result:
+        print("Error: " + result['error'])
+    elif 'sha256' in result:
+        print("SHA-256 " + result['sha256'])
+    return 0 if result['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import collections
+import re
+
+SYNC = b'\x7e\xaa\x99\x7e'
+
+# the CRAM bank width and height of each iCE40 die
+DIES = {
+    (332, 144): '1k',
+    (692, 336): '5k',
+    (872, 272): '8k',
+}
+
+# the B1 (iCE40LP4K) and the B2 (iCE40LP8K) have the same die, so their
+# bitstreams can't be told apart
+BOARD_DIE = '8k'
+
+PART_DIES = {
+    'LP1K': '1k', 'HX1K': '1k',
+    'UP3K': '5k', 'UP5K': '5k',
+    'LP4K': '8k', 'HX4K': '8k', 'LP8K': '8k', 'HX8K': '8k',
+}
+
+# die is None without CRAM data, part is the one named in the comment (if
+# any), end is the offset after the wakeup command and None for multiboot
+# images
+Bitstream = collections.namedtuple(
+    'Bitstream', 'die part comment crc_checks end')
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def _crc16(crc, data):
+    # CRC-16-CCITT, MSB first
+    table = _CRC_TABLE
+    for byte in bytearray(data):
+        crc = (crc << 8 & 0xffff) ^ table[crc >> 8 ^ byte]
+    return crc
+
+
+def analyze(data):
+    # parse the configuration commands of an iCE40 bitstream; returns a
+    # Bitstream, None for data that doesn't start like one and raises
+    # ValueError for a broken bitstream
+    data = bytearray(data)
+    offset = 0
+    comment = []
+    if data[:2] == b'\xff\x00':
+        comment_end = data.find(b'\x00\xff', 2)
+        if comment_end < 0:
+            return None
+        comment = [line.decode('latin-1')
+                   for line in bytes(data[2:comment_end]).split(b'\x00')
+                   if line]
+        offset = comment_end + 2
+    if data[offset:offset + 4] != SYNC:
+        return None
+    offset += 4
+
+    part = None
+    for line in comment:
+        match = re.search(r'iCE40(LP|HX|UP)(\d+K)', line, re.I)
+        if match:
+            part = match.group(0)
+            break
+    die = None
+    width = height = None
+    crc = 0xffff
+    crc_checks = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError('Bitstream ends before the wakeup command')
+        start = offset
+        command = data[offset] >> 4
+        payload_length = data[offset] & 0xf
+        offset += 1 + payload_length
+        if offset > len(data):
+            raise ValueError('Truncated command at {:06x}'.format(start))
+        payload = 0
+        for byte in data[start + 1:offset]:
+            payload = payload << 8 | byte
+        crc = _crc16(crc, data[start:offset])
+        if command == 0 and payload in (1, 3):
+            # CRAM or BRAM data of the current bank, then two zero bytes
+            if width is None or height is None:
+                raise ValueError('Bank data before the bank size at {:06x}'
+                                 .format(start))
+            if payload == 1 and die is None:
+                die = DIES.get((width, height), '{}x{}'.format(width, height))
+            length = width * height // 8 + 2
+            if offset + length > len(data):
+                raise ValueError('Truncated bank data at {:06x}'.format(
+                    start))
+            crc = _crc16(crc, data[offset:offset + length])
+            offset += length
+        elif command == 0 and payload == 5:
+            crc = 0xffff
+        elif command == 0 and payload == 6:
+            # wakeup, the FPGA reads no further
+            break
+        elif command == 0 and payload == 8:
+            # reboot into one of the images listed by a multiboot header
+            return Bitstream(None, part, comment, crc_checks, None)
+        elif command == 2:
+            # the checked CRC covers itself, so it ends at zero
+            if crc:
+                raise ValueError('CRC error before {:06x}'.format(start))
+            crc_checks += 1
+        elif command == 6:
+            width = payload + 1
+        elif command == 7:
+            height = payload
+        elif command not in (1, 5, 8, 9):
+            raise ValueError('Unknown command {:02x} at {:06x}'.format(
+                data[start], start))
+    return Bitstream(die, part, comment, crc_checks, offset)
+
+
+def check(data, die=BOARD_DIE):
+    # the part of data to program, without the padding after the wakeup
+    # command of a bitstream; raises ValueError for a broken bitstream or
+    # one for another die.  other data is returned as it is.
+    bitstream = analyze(data)
+    if bitstream is None or bitstream.end is None:
+        return data
+    if bitstream.die != die:
+        raise ValueError('Bitstream for an iCE40 {} die, not {}'.format(
+            bitstream.die, die))
+    if bitstream.part is not None and \
+            PART_DIES.get(bitstream.part[5:].upper(), die) != die:
+        raise ValueError('Bitstream for an {}, not an iCE40 {} die'.format(
+            bitstream.part, die))
+    if not data[bitstream.end:].strip(b'\x00\xff'):
+        return data[:bitstream.end]
+    return data
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import re
+import time
+
+from tinyfpgab.cache import _sector_ranges, cache_path, load_json
+from tinyfpgab.cache import save_json
+
+
+def default_path(board):
+    return cache_path('journal-{}.json'.format(
+        re.sub(r'[^A-Za-z0-9_.-]', '_', board)))
+
+
+def _image_key(regions):
+    digest = hashlib.sha256()
+    for addr, data in sorted(regions, key=lambda region: region[0]):
+        digest.update('{:06x}:{:x}:'.format(addr, len(data)).encode('ascii'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class Journal(object):
+    # records which parts of an image were verified on a board, so that
+    # programming it again after a dropped port or a crash only has to do
+    # the rest.  parts never cross a 4k sector boundary.  with a path the
+    # journal is saved after every verified range and ignored when it is
+    # older than max_age; finish() deletes it.
+
+    def __init__(self, regions, path=None, max_age=24 * 3600):
+        self.path = path
+        self.key = _image_key(regions)
+        self.verified = set()
+        journal = {} if path is None else load_json(path)
+        if journal.get('image') == self.key and \
+                time.time() - journal.get('saved', 0) <= max_age:
+            self.verified = set(journal['verified'])
+
+    def save(self):
+        if self.path is None:
+            return
+        save_json(self.path, {'image': self.key, 'saved': time.time(),
+                              'verified': sorted(self.verified)})
+
+    @staticmethod
+    def _key(start, end):
+        return '{:06x}-{:06x}'.format(start, end)
+
+    def record(self, addr, length):
+        for start, end in _sector_ranges(addr, length):
+            self.verified.add(self._key(start, end))
+        self.save()
+
+    def remaining(self, regions):
+        # the (addr, data) parts of the regions not verified yet
+        if not self.verified:
+            return list(regions)
+        result = []
+        for addr, data in regions:
+            for start, end in _sector_ranges(addr, len(data)):
+                if self._key(start, end) in self.verified:
+                    continue
+                if result and result[-1][0] + len(result[-1][1]) == start:
+                    result[-1] = (result[-1][0], result[-1][1] +
+                                  data[start - addr:end - addr])
+                else:
+                    result.append((start, data[start - addr:end - addr]))
+        return result
+
+    def finish(self):
+        self.verified = set()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
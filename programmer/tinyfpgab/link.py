@@ -0,0 +1,173 @@
+import collections
+import threading
+import time
+
+from tinyfpgab import TinyFPGAB
+from tinyfpgab.cache import cache_path, load_json, save_json
+from tinyfpgab.session import open_serial
+
+# how a board is reached: baud rates to try (fastest first), read sizes and
+# windows to try, the largest page program and the seconds a board needs
+# after its port is opened
+Transport = collections.namedtuple(
+    'Transport', 'name bauds read_sizes max_write windows settle')
+
+# the FPGA's own USB CDC bootloader: the baud rate means nothing, and the
+# stock bootloader crashes on frames reading or writing more than 16 bytes,
+# so only the window is tuned
+NATIVE = Transport('native', (115200,), (16,), 16, (1, 2, 4, 8), 0)
+
+# a USB serial adapter to the flash, like the Arduino of programmer.ino:
+# 115200 baud unless its firmware was changed, frames of at most 128 bytes
+# each way (so 127 read and 124 written, with opcode and address) and a
+# reset whenever the port is opened
+UART = Transport('uart', (1000000, 500000, 230400, 115200),
+                 (16, 32, 64, 127), 124, (1, 2, 4), 2.0)
+
+TRANSPORTS = {
+    '1209:2100': NATIVE,
+}
+
+LinkProfile = collections.namedtuple(
+    'LinkProfile', 'transport baudrate timeout read_size write_size window')
+
+# read back during calibration, for every candidate
+CALIBRATION_ADDR = 0
+CALIBRATION_LENGTH = 0x400
+
+# boards tuned in parallel share the profile file
+_save_lock = threading.Lock()
+
+
+def default_path():
+    return cache_path('links.json')
+
+
+def transport(device):
+    # the transport of a vendor:product device id
+    return TRANSPORTS.get(device.lower(), UART)
+
+
+def calibrate(port, link, opener=open_serial, timer=time.time,
+              sleep=time.sleep, progress=None):
+    # find the fastest settings that read the flash correctly over a
+    # transport, and the largest page program frames that get through;
+    # returns a LinkProfile, or None without a bootloader
+    progress = progress or (lambda info: None)
+    for baudrate in link.bauds:
+        ser = opener(port, baudrate=baudrate, timeout=0.2)
+        sleep(link.settle)
+        fpga = TinyFPGAB(ser)
+        last = baudrate == link.bauds[-1]
+        if fpga.is_bootloader_active(6 if last else 2):
+            break
+        ser.close()
+        progress("No bootloader at {} baud".format(baudrate))
+    else:
+        return None
+
+    def measure(read_size, window):
+        # seconds to read the calibration range, None if it came back wrong
+        fpga.read_size = read_size
+        fpga.window = window
+        started = timer()
+        try:
+            data = fpga.read(CALIBRATION_ADDR, CALIBRATION_LENGTH)
+        except IOError:
+            data = None
+        seconds = timer() - started
+        if data == reference:
+            progress("Read size {}, window {}: {:.3f}s".format(
+                read_size, window, seconds))
+            return seconds
+        progress("Read size {}, window {}: failed".format(read_size, window))
+        drain()
+        return None
+
+    def passes_write(write_size):
+        # a status read padded to the frame of a page program: the flash
+        # ignores the padding, but the frame has to get through
+        status = fpga.cmd(0x05, data=b'\x00' * (write_size + 3), read_len=1)
+        if len(status) == 1 and not ord(status) & 1:
+            return True
+        progress("Write size {}: failed".format(write_size))
+        drain()
+        return False
+
+    def drain():
+        # let whatever is still on its way arrive, then drop it
+        sleep(0.2)
+        if hasattr(ser, 'reset_input_buffer'):
+            ser.reset_input_buffer()
+
+    try:
+        reference = fpga.read(CALIBRATION_ADDR, CALIBRATION_LENGTH)
+        if len(reference) != CALIBRATION_LENGTH:
+            return None
+        best = (measure(16, 1), 16, 1)
+        if best[0] is None:
+            return None
+        # larger transfers stop working at some size, don't go past it
+        for read_size in link.read_sizes:
+            if read_size > 16:
+                seconds = measure(read_size, 1)
+                if seconds is None:
+                    break
+                if seconds < best[0]:
+                    best = (seconds, read_size, 1)
+        for window in link.windows:
+            if window > 1:
+                seconds = measure(best[1], window)
+                if seconds is None:
+                    break
+                if seconds < best[0]:
+                    best = (seconds, best[1], window)
+        # page programs split at 256 byte boundaries, keep to a power of two
+        write_size = 16
+        while write_size * 2 <= link.max_write and \
+                passes_write(write_size * 2):
+            write_size *= 2
+    finally:
+        ser.close()
+
+    seconds, read_size, window = best
+    transfers = -(-CALIBRATION_LENGTH // read_size) // window or 1
+    timeout = max(0.2, round(4 * seconds / transfers, 3))
+    return LinkProfile(link.name, baudrate, timeout, read_size, write_size,
+                       window)
+
+
+class ProfileCache(object):
+    # the link profile tuned for each board (the device id and its USB
+    # serial number or port), retuned after max_age
+
+    def __init__(self, path=None, max_age=30 * 24 * 3600):
+        self.path = default_path() if path is None else path
+        self.max_age = max_age
+
+    def _load(self):
+        return load_json(self.path).get('links', {})
+
+    def get(self, key):
+        link = self._load().get(key)
+        if link is None or time.time() - link['tuned'] > self.max_age:
+            return None
+        try:
+            return LinkProfile(*[link[field]
+                                 for field in LinkProfile._fields])
+        except KeyError:
+            return None
+
+    def _save(self, update):
+        with _save_lock:
+            # merge with what other programmer runs saved in the meantime
+            links = self._load()
+            update(links)
+            save_json(self.path, {'links': links})
+
+    def put(self, key, profile):
+        link = dict(zip(LinkProfile._fields, profile), tuned=time.time())
+        self._save(lambda links: links.__setitem__(key, link))
+
+    def forget(self, key):
+        self._save(lambda links: links.pop(key, None))
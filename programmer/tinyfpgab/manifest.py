@@ -0,0 +1,77 @@
+import collections
+import json
+import os
+
+from tinyfpgab import FLASH_SIZE, TinyFPGAB
+
+Region = collections.namedtuple('Region', 'filename addr data')
+
+
+def _parse(path, text):
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import toml as tomllib
+            except ImportError:
+                raise ValueError('TOML manifests need Python 3.11 or the '
+                                 'toml package, use JSON instead')
+        return tomllib.loads(text)
+    return json.loads(text)
+
+
+def _addr(value):
+    try:
+        return int(value, 0)
+    except TypeError:
+        return int(value)
+
+
+def load(path):
+    # a manifest lists the images to put in flash, as JSON (or TOML):
+    #   {"regions": [{"file": "top.bin", "addr": "0x30000"},
+    #                {"file": "data.bin", "addr": "0x60000"}]}
+    # file names are relative to the manifest, addr defaults to the
+    # bitstream address and .delta files name their base image in "base".
+    # returns the regions sorted by address.
+    with open(path) as f:
+        try:
+            manifest = _parse(path, f.read())
+        except ValueError as e:
+            raise ValueError('Invalid manifest {}: {}'.format(path, e))
+    entries = manifest.get('regions') if isinstance(manifest, dict) \
+        else manifest
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('No regions in manifest ' + path)
+
+    fpga = TinyFPGAB(None)
+    regions = []
+    for entry in entries:
+        if not isinstance(entry, dict) or 'file' not in entry:
+            raise ValueError('Region without a file: {}'.format(entry))
+        filename = os.path.join(os.path.dirname(path), entry['file'])
+        base = entry.get('base')
+        if base is not None:
+            base = os.path.join(os.path.dirname(path), base)
+        addr, data = fpga.slurp(filename, base)
+        if 'addr' in entry:
+            try:
+                addr = _addr(entry['addr'])
+            except (TypeError, ValueError):
+                raise ValueError('Invalid addr for {}: {}'.format(
+                    entry['file'], entry['addr']))
+        if addr < 0:
+            raise ValueError('Negative write addr for {}: {}'.format(
+                entry['file'], addr))
+        if addr + len(data) > FLASH_SIZE:
+            raise ValueError('{} at {:06x} ends past the {:06x} byte flash'
+                             .format(entry['file'], addr, FLASH_SIZE))
+        regions.append(Region(entry['file'], addr, data))
+
+    regions.sort(key=lambda region: region.addr)
+    for prev, region in zip(regions, regions[1:]):
+        if region.addr < prev.addr + len(prev.data):
+            raise ValueError('{} at {:06x} overlaps {} at {:06x}'.format(
+                region.filename, region.addr, prev.filename, prev.addr))
+    return regions
@@ -0,0 +1,60 @@
+from tinyfpgab import TinyFPGAB
+
+
+def open_serial(port, baudrate=115200, timeout=0.2):
+    import serial
+    return serial.Serial(port, baudrate, timeout=timeout,
+                         writeTimeout=timeout)
+
+
+class Session(object):
+    # keeps one serial port to a board open across bootloader detection,
+    # programming retries and boot, instead of reopening it and detecting
+    # the bootloader again for every step.  keyword arguments are passed
+    # on to TinyFPGAB.
+    def __init__(self, port, opener=open_serial, **kwargs):
+        self.port = port
+        self.opener = opener
+        self.kwargs = kwargs
+        self.ser = None
+        self.fpga = None
+        self.active = False
+
+    def open(self):
+        if self.ser is None or not getattr(self.ser, 'is_open', True):
+            self.ser = self.opener(self.port)
+            if hasattr(self.ser, 'reset_input_buffer'):
+                self.ser.reset_input_buffer()
+            self.fpga = TinyFPGAB(self.ser, **self.kwargs)
+            self.active = False
+        return self.fpga
+
+    def detect(self):
+        # True if the bootloader answers, only asked again after a failed
+        # detection or a reopen
+        fpga = self.open()
+        if not self.active:
+            self.active = fpga.is_bootloader_active()
+        return self.active
+
+    def reset(self):
+        # forget the detection, e.g. after an error on the port
+        self.close()
+
+    def boot(self):
+        # the board leaves the bootloader and its port goes away
+        self.open().boot()
+        self.close()
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+        self.ser = None
+        self.fpga = None
+        self.active = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
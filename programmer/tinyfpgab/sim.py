@@ -0,0 +1,290 @@
+import collections
+import os
+import random
+import struct
+import threading
+import time
+
+
+class VirtualClock(object):
+    # a clock that only moves when something sleeps on it, so simulated
+    # busy times and USB latencies cost no real time
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class RealClock(object):
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+
+class SimulatedFlash(object):
+    # AT25SF041: 4 Mbit, 256 byte pages, 4k/32k/64k erase, programming only
+    # clears bits, WIP and WEL status bits, JEDEC id 1f 84 01
+    JEDEC_ID = b'\x1f\x84\x01'
+    ERASE_SIZES = {0x20: 4 * 1024, 0x52: 32 * 1024, 0xd8: 64 * 1024}
+
+    def __init__(self, size=0x80000, clock=None, page_program_time=0.0007,
+                 erase_times=None, read_error_rate=0.0,
+                 program_error_rate=0.0, min_status_delay=None, seed=None):
+        self.memory = bytearray(b'\xff' * size)
+        self.clock = RealClock() if clock is None else clock
+        self.page_program_time = page_program_time
+        self.erase_times = erase_times or {0x20: 0.05, 0x52: 0.15, 0xd8: 0.25}
+        self.read_error_rate = read_error_rate
+        self.program_error_rate = program_error_rate
+        # the bootloader corrupts a page program in progress if the status
+        # register is read too early, set this to model it
+        self.min_status_delay = min_status_delay
+        self.random = random.Random(seed)
+        self.write_enabled = False
+        self.powered_down = False
+        self.busy_until = 0.0
+        self.busy_started = 0.0
+        self.last_program = None
+        self.stats = collections.Counter()
+
+    @property
+    def busy(self):
+        return self.clock.time() < self.busy_until
+
+    def _addr(self, data):
+        return struct.unpack('>I', b'\x00' + bytes(data[1:4]))[0] % len(
+            self.memory)
+
+    def _flip(self, data, rate):
+        for i in range(len(data)):
+            if rate and self.random.random() < rate:
+                data[i] ^= 1 << self.random.randrange(8)
+        return data
+
+    def _start_busy(self, seconds):
+        self.busy_started = self.clock.time()
+        self.busy_until = self.busy_started + seconds
+        self.write_enabled = False
+
+    def transfer(self, data, read_len):
+        # one SPI transaction: data is clocked out, then read_len bytes are
+        # clocked in
+        data = bytearray(data)
+        if not data:
+            return bytearray(b'\xff' * read_len)
+        opcode = data[0]
+        self.stats[opcode] += 1
+
+        if self.powered_down:
+            if opcode == 0xab:
+                self.powered_down = False
+            return bytearray(b'\xff' * read_len)
+
+        if opcode == 0x05:
+            if self.busy and self.min_status_delay is not None and \
+                    self.last_program is not None and \
+                    self.clock.time() - self.busy_started < \
+                    self.min_status_delay:
+                # the interrupted program leaves some bits unprogrammed
+                self.memory[self.last_program] |= self.random.randrange(
+                    1, 256)
+            status = (1 if self.busy else 0) | (2 if self.write_enabled else 0)
+            return bytearray([status] * read_len)
+        if self.busy:
+            # everything but the status register read is ignored
+            return bytearray(b'\xff' * read_len)
+
+        if opcode == 0x9f:
+            output = bytearray(self.JEDEC_ID * (read_len // 3 + 1))
+            return output[:read_len]
+        if opcode == 0xab:
+            return bytearray(b'\xff' * read_len)
+        if opcode == 0xb9:
+            self.powered_down = True
+        elif opcode == 0x06:
+            self.write_enabled = True
+        elif opcode == 0x04:
+            self.write_enabled = False
+        elif opcode in (0x03, 0x0b) and len(data) >= 4:
+            # for fast reads the host sends the dummy byte with the address
+            addr = self._addr(data)
+            output = bytearray(
+                self.memory[(addr + i) % len(self.memory)]
+                for i in range(read_len))
+            return self._flip(output, self.read_error_rate)
+        elif opcode == 0x02 and len(data) >= 4 and self.write_enabled:
+            addr = self._addr(data)
+            page = addr & ~0xff
+            payload = self._flip(bytearray(data[4:]), self.program_error_rate)
+            for i, value in enumerate(payload[-256:]):
+                offset = page + ((addr + i) & 0xff)
+                self.memory[offset] &= value
+            self.last_program = addr
+            self._start_busy(self.page_program_time)
+        elif opcode in self.ERASE_SIZES and len(data) >= 4 and \
+                self.write_enabled:
+            size = self.ERASE_SIZES[opcode]
+            addr = self._addr(data) & ~(size - 1)
+            self.memory[addr:addr + size] = b'\xff' * size
+            self.last_program = None
+            self._start_busy(self.erase_times[opcode])
+        elif opcode in (0x60, 0xc7) and self.write_enabled:
+            self.memory[:] = b'\xff' * len(self.memory)
+            self.last_program = None
+            self._start_busy(max(self.erase_times.values()) * 8)
+        return bytearray(b'\xff' * read_len)
+
+
+class SimulatedBootloader(object):
+    # a serial port object speaking the usb_spi_bridge_ep protocol to a
+    # SimulatedFlash, usable in place of a pyserial port
+    def __init__(self, flash=None, latency=0.0, clock=None,
+                 max_transfer=None):
+        self.clock = RealClock() if clock is None else clock
+        self.flash = SimulatedFlash(clock=self.clock) if flash is None \
+            else flash
+        # seconds per USB round trip, charged on every flush and on every
+        # read that has to wait for a response
+        self.latency = latency
+        # frames writing or reading more bytes are dropped unanswered, like
+        # a bridge with small buffers would
+        self.max_transfer = max_transfer
+        self.booted = False
+        self.pins = {}
+        self.pending = bytearray()
+        self.output = bytearray()
+        self.stats = collections.Counter()
+        self.is_open = True
+
+    def _process(self):
+        while self.pending and not self.booted:
+            command = self.pending[0]
+            if command == 0x00:
+                self.booted = True
+                del self.pending[:]
+            elif command == 0x01:
+                if len(self.pending) < 5:
+                    return
+                write_len, read_len = struct.unpack(
+                    '<HH', bytes(self.pending[1:5]))
+                if len(self.pending) < 5 + write_len:
+                    return
+                data = self.pending[5:5 + write_len]
+                del self.pending[:5 + write_len]
+                if self.max_transfer is not None and max(
+                        write_len, read_len - 1) > self.max_transfer:
+                    self.stats['dropped'] += 1
+                    continue
+                # the bridge is told one more byte than it returns
+                self.output += self.flash.transfer(data, max(read_len - 1, 0))
+                self.stats['frames'] += 1
+            elif command & 0x80:
+                self.pins[command & 0x1f] = (
+                    bool(command & 0x40), bool(command & 0x20))
+                del self.pending[:1]
+            else:
+                del self.pending[:1]
+
+    def write(self, data):
+        self.stats['writes'] += 1
+        self.pending += data
+        self._process()
+        return len(data)
+
+    def flush(self):
+        self.stats['flushes'] += 1
+        self.clock.sleep(self.latency)
+
+    def read(self, size=1):
+        if size:
+            self.stats['reads'] += 1
+            self.clock.sleep(self.latency)
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def reset_input_buffer(self):
+        del self.output[:]
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def serve_pty(bootloader):
+    # expose a simulated bootloader on a pseudo terminal (POSIX only) so
+    # the CLI can talk to it; returns the name of the port to open
+    import pty
+    import select
+    import tty
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+
+    def pump():
+        while bootloader.is_open:
+            if not select.select([master], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            bootloader.write(data)
+            bootloader.flush()
+            response = bootloader.read(bootloader.in_waiting)
+            if response:
+                os.write(master, response)
+
+    thread = threading.Thread(target=pump)
+    thread.daemon = True
+    thread.start()
+    return name
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="simulated TinyFPGA B-series bootloader on a pty")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds per USB round trip")
+    parser.add_argument("--read-error-rate", type=float, default=0.0,
+                        help="probability of a bit error per byte read")
+    parser.add_argument("--program-error-rate", type=float, default=0.0,
+                        help="probability of a bit error per byte programmed")
+    parser.add_argument("--max-transfer", type=int,
+                        help="drop frames writing or reading more bytes")
+    args = parser.parse_args()
+
+    flash = SimulatedFlash(read_error_rate=args.read_error_rate,
+                           program_error_rate=args.program_error_rate)
+    bootloader = SimulatedBootloader(flash, latency=args.latency,
+                                     max_transfer=args.max_transfer)
+    print("Simulated bootloader on " + serve_pty(bootloader))
+    try:
+        while not bootloader.booted:
+            time.sleep(0.1)
+        print("Booted")
+    except KeyboardInterrupt:
+        pass
+    bootloader.close()
+
+
+if __name__ == '__main__':
+    main()
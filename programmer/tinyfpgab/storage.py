@@ -0,0 +1,181 @@
+import collections
+import errno
+import io
+
+from tinyfpgab import FLASH_SIZE, USER_ADDR, diff_plan
+
+SECTOR_SIZE = 0x1000
+
+
+class FlashDevice(io.RawIOBase):
+    # the flash of a board in the bootloader as a seekable binary file,
+    # positions being flash addresses.  whole 4k sectors are read and kept
+    # in an LRU cache of cache_size sectors.  writes only change the cache;
+    # flush(), close() or evicting a changed sector program the changed
+    # sectors, erasing only those where a bit has to go from 0 to 1, and
+    # verify them.  writes below protect, where the bootloader lives, fail.
+
+    def __init__(self, fpga, size=FLASH_SIZE, protect=USER_ADDR,
+                 cache_size=16):
+        io.RawIOBase.__init__(self)
+        self.fpga = fpga
+        self.size = size
+        self.protect = protect
+        self.cache_size = cache_size
+        self.position = 0
+        # sector address -> contents, least recently used first
+        self.sectors = collections.OrderedDict()
+        # sector address -> contents in flash (None if never read), for the
+        # sectors changed since they were last programmed
+        self.dirty = {}
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self.position = offset
+        return offset
+
+    def _pieces(self, addr, length):
+        # (sector_addr, start, end) of the sectors of a range, with start
+        # and end relative to the sector, at most cache_size sectors at a
+        # time so that they all fit in the cache
+        pieces = []
+        end = addr + length
+        while addr < end:
+            sector_addr = addr & ~(SECTOR_SIZE - 1)
+            sector_end = min(sector_addr + SECTOR_SIZE, end)
+            pieces.append((sector_addr, addr - sector_addr,
+                           sector_end - sector_addr))
+            if len(pieces) == self.cache_size:
+                yield pieces
+                pieces = []
+            addr = sector_end
+        if pieces:
+            yield pieces
+
+    def _load(self, sector_addrs):
+        # make sure the sectors are cached, reading the missing ones in one
+        # go, and mark them as the most recently used
+        missing = [sector_addr for sector_addr in sector_addrs
+                   if sector_addr not in self.sectors]
+        for sector_addr in sector_addrs:
+            if sector_addr in self.sectors:
+                self.sectors[sector_addr] = self.sectors.pop(sector_addr)
+        data = self.fpga._read_ranges(
+            [(sector_addr, SECTOR_SIZE) for sector_addr in missing])
+        for sector_addr, sector in zip(missing, data):
+            if len(sector) != SECTOR_SIZE:
+                raise IOError('Short read at {:06x}'.format(sector_addr))
+            self.sectors[sector_addr] = sector
+        self._evict()
+
+    def _evict(self):
+        while len(self.sectors) > self.cache_size:
+            sector_addr = next(iter(self.sectors))
+            if sector_addr in self.dirty:
+                self._program([sector_addr])
+            del self.sectors[sector_addr]
+
+    def readinto(self, b):
+        view = memoryview(b)
+        length = max(0, min(len(view), self.size - self.position))
+        offset = 0
+        for pieces in self._pieces(self.position, length):
+            self._load([sector_addr for sector_addr, _, _ in pieces])
+            for sector_addr, start, end in pieces:
+                view[offset:offset + end - start] = \
+                    self.sectors[sector_addr][start:end]
+                offset += end - start
+        self.position += length
+        return length
+
+    def write(self, b):
+        data = memoryview(b)
+        length = len(data)
+        if self.position < self.protect:
+            raise IOError(errno.EACCES, 'Write to the protected flash below '
+                          '{:06x}'.format(self.protect))
+        if self.position + length > self.size:
+            raise IOError(errno.ENOSPC, 'Write past the end of the flash')
+        offset = 0
+        for pieces in self._pieces(self.position, length):
+            # sectors that are overwritten completely need not be read
+            self._load([sector_addr for sector_addr, start, end in pieces
+                        if end - start < SECTOR_SIZE or
+                        sector_addr in self.sectors])
+            for sector_addr, start, end in pieces:
+                sector = self.sectors.get(sector_addr)
+                if sector is None:
+                    sector = self.sectors[sector_addr] = bytearray(
+                        SECTOR_SIZE)
+                    self.dirty[sector_addr] = None
+                elif sector_addr not in self.dirty:
+                    self.dirty[sector_addr] = bytes(sector)
+                sector[start:end] = data[offset:offset + end - start]
+                offset += end - start
+            self._evict()
+        self.position += length
+        return length
+
+    def _program(self, sector_addrs):
+        # program the changed sectors, in runs of consecutive ones
+        erase_ranges = []
+        program_ranges = []
+        for sector_addr in sorted(sector_addrs):
+            current = self.dirty[sector_addr]
+            if current is None:
+                erase, program = [(sector_addr,
+                                   sector_addr + SECTOR_SIZE)], []
+            else:
+                erase, program, _ = diff_plan(
+                    sector_addr, current, self.sectors[sector_addr])
+            for start, end in erase:
+                # merged, so that erase() can use the block erase opcodes
+                if erase_ranges and erase_ranges[-1][1] == start:
+                    erase_ranges[-1] = (erase_ranges[-1][0], end)
+                else:
+                    erase_ranges.append((start, end))
+            program_ranges += program
+
+        for start, end in erase_ranges:
+            self.fpga.erase(start, end - start)
+        for start, end in sorted(erase_ranges + program_ranges):
+            data = self._contents(start, end)
+            self.fpga.write(start, data)
+            if not self.fpga._verify(start, data):
+                raise IOError('Verification failed at {:06x}'.format(start))
+        for sector_addr in sector_addrs:
+            del self.dirty[sector_addr]
+
+    def _contents(self, start, end):
+        data = bytearray()
+        while start < end:
+            sector_addr = start & ~(SECTOR_SIZE - 1)
+            stop = min(sector_addr + SECTOR_SIZE, end)
+            data += self.sectors[sector_addr][start - sector_addr:
+                                              stop - sector_addr]
+            start = stop
+        return bytes(data)
+
+    def flush(self):
+        if self.dirty:
+            self._program(list(self.dirty))
+        io.RawIOBase.flush(self)
@@ -0,0 +1,340 @@
+import collections
+import struct
+import sys
+import time
+import timeit
+
+# a trace is MAGIC followed by one record per serial port call: the kind
+# (W write, F flush, R read), the wall and the CPU microseconds since the
+# previous call returned, the microseconds the call took, the requested
+# length and the length of the data written or read, then that data
+MAGIC = b'TFBT\x01'
+_RECORD = struct.Struct('<cIIIII')
+
+Record = collections.namedtuple(
+    'Record', 'kind gap cpu duration requested data')
+
+OPCODES = {
+    0x02: 'page program',
+    0x04: 'write disable',
+    0x05: 'read status',
+    0x06: 'write enable',
+    0x0b: 'fast read',
+    0x20: '4k erase',
+    0x52: '32k erase',
+    0x9f: 'read id',
+    0xab: 'wake',
+    0xb9: 'sleep',
+    0xd8: '64k erase',
+}
+
+BUSY_OPCODES = (0x02, 0x20, 0x52, 0xd8)
+
+try:
+    _cpu_timer = time.process_time
+except AttributeError:  # Python 2
+    _cpu_timer = time.clock
+
+
+def _us(seconds):
+    return max(0, min(int(seconds * 1e6), 0xffffffff))
+
+
+class TraceRecorder(object):
+    # wraps a serial port to write every call on it to the trace file f
+    def __init__(self, ser, f, timer=timeit.default_timer,
+                 cpu_timer=_cpu_timer):
+        self.ser = ser
+        self.f = f
+        self.timer = timer
+        self.cpu_timer = cpu_timer
+        # a reopened port goes on with the same trace
+        if not f.tell():
+            f.write(MAGIC)
+        self.last = timer()
+        self.last_cpu = cpu_timer()
+
+    def _record(self, kind, started, cpu, requested, data):
+        ended, ended_cpu = self.timer(), self.cpu_timer()
+        self.f.write(_RECORD.pack(
+            kind, _us(started - self.last), _us(cpu - self.last_cpu),
+            _us(ended - started), requested, len(data)))
+        self.f.write(data)
+        # the time spent recording counts as host time
+        self.last = ended
+        self.last_cpu = ended_cpu
+
+    def write(self, data):
+        started, cpu = self.timer(), self.cpu_timer()
+        result = self.ser.write(data)
+        self._record(b'W', started, cpu, len(data), data)
+        return result
+
+    def flush(self):
+        started, cpu = self.timer(), self.cpu_timer()
+        self.ser.flush()
+        self._record(b'F', started, cpu, 0, b'')
+
+    def read(self, size=1):
+        started, cpu = self.timer(), self.cpu_timer()
+        data = self.ser.read(size)
+        self._record(b'R', started, cpu, size, data)
+        return data
+
+    def readinto(self, b):
+        started, cpu = self.timer(), self.cpu_timer()
+        view = memoryview(b)
+        readinto = getattr(self.ser, 'readinto', None)
+        if readinto is not None:
+            length = readinto(view)
+        else:
+            data = self.ser.read(len(view))
+            length = len(data)
+            view[:length] = data
+        self._record(b'R', started, cpu, len(view), view[:length].tobytes())
+        return length
+
+    def close(self):
+        self.f.flush()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+def read_trace(f):
+    # the records of a trace file
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a trace file')
+    while True:
+        header = f.read(_RECORD.size)
+        if not header:
+            return
+        if len(header) < _RECORD.size:
+            raise ValueError('Truncated trace')
+        kind, gap, cpu, duration, requested, length = _RECORD.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError('Truncated trace')
+        yield Record(kind, gap, cpu, duration, requested, data)
+
+
+def _opcodes(data):
+    # the SPI opcodes of the frames written, None for a boot command
+    data = bytearray(data)
+    opcodes = []
+    offset = 0
+    while offset < len(data):
+        if data[offset] == 0x00:
+            opcodes.append(None)
+            offset += 1
+        elif data[offset] == 0x01 and offset + 5 <= len(data):
+            write_len = data[offset + 1] | data[offset + 2] << 8
+            if write_len:
+                opcodes.append(data[offset + 5])
+            offset += 5 + write_len
+        else:
+            break
+    return opcodes
+
+
+def profile(records):
+    # where the time of a trace went.  a transfer is a write with the
+    # flushes and reads after it, timed from the write to its last read and
+    # counted for the opcode of its last frame; idle gaps are the host time
+    # before a transfer.  busy is the time from a page program or an erase
+    # to the status read that found the flash ready.
+    latencies = collections.defaultdict(list)
+    busy = collections.defaultdict(list)
+    idle = []
+    cpu = total = device = 0
+    transfer = None
+    busy_since = None
+
+    def finish():
+        opcode = transfer['opcodes'][-1] if transfer['opcodes'] else None
+        latencies[opcode].append(transfer['seconds'])
+
+    for record in records:
+        gap, duration = record.gap / 1e6, record.duration / 1e6
+        total += gap + duration
+        device += duration
+        cpu += record.cpu / 1e6
+        if record.kind == b'W':
+            if transfer is not None:
+                finish()
+            idle.append(gap)
+            transfer = {'opcodes': _opcodes(record.data), 'seconds': duration}
+            if transfer['opcodes'] and \
+                    transfer['opcodes'][-1] in BUSY_OPCODES:
+                busy_since = (transfer['opcodes'][-1], total)
+            continue
+        if transfer is None:
+            continue
+        transfer['seconds'] += gap + duration
+        if record.kind == b'R' and transfer['opcodes'][-1:] == [0x05] and \
+                record.data and busy_since is not None and \
+                not bytearray(record.data)[-1] & 1:
+            busy[busy_since[0]].append(total - busy_since[1])
+            busy_since = None
+    if transfer is not None:
+        finish()
+    return {
+        'seconds': total,
+        'device_seconds': device,
+        'cpu_seconds': cpu,
+        'transfers': sum(len(values) for values in latencies.values()),
+        'latencies': dict(latencies),
+        'busy': dict(busy),
+        'idle': idle,
+    }
+
+
+def _stats(values):
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    return "{:6} {:9.1f} {:7.3f} {:7.3f} {:7.3f} {:7.3f} {:8.3f}".format(
+        len(values), sum(values) * 1000, values[0] * 1000, percentile(0.5),
+        percentile(0.9), percentile(0.99), values[-1] * 1000)
+
+
+def report(result, out=None):
+    out = sys.stdout if out is None else out
+    out.write("{:.3f}s traced, {:.3f}s in serial calls, {:.3f}s host CPU, "
+              "{} transfers\n".format(
+                  result['seconds'], result['device_seconds'],
+                  result['cpu_seconds'], result['transfers']))
+    out.write("{:24} {:>6} {:>9} {:>7} {:>7} {:>7} {:>7} {:>8}\n".format(
+        "", "count", "total ms", "min", "median", "p90", "p99", "max"))
+    for title, values in (('latency', result['latencies']),
+                          ('busy', result['busy'])):
+        for opcode in sorted(values, key=lambda o: -1 if o is None else o):
+            name = 'boot' if opcode is None else '{:02x} {}'.format(
+                opcode, OPCODES.get(opcode, '?'))
+            out.write("{:24} {}\n".format(
+                '{} {}'.format(title, name)[:24], _stats(values[opcode])))
+    if result['idle']:
+        out.write("{:24} {}\n".format("idle gaps", _stats(result['idle'])))
+
+
+class TraceReplay(object):
+    # a serial port answering with the reads of a trace, to run the
+    # library against a capture without hardware.  raises IOError when the
+    # library writes something else than the trace has.
+    def __init__(self, records):
+        self.records = [record for record in records if record.kind != b'F']
+        self.index = 0
+        self.is_open = True
+
+    def _next(self, kind):
+        if self.index >= len(self.records) or \
+                self.records[self.index].kind != kind:
+            raise IOError('Trace diverges at call {}: no {} expected'.format(
+                self.index, 'write' if kind == b'W' else 'read'))
+        self.index += 1
+        return self.records[self.index - 1]
+
+    def write(self, data):
+        if self._next(b'W').data != bytes(data):
+            raise IOError('Trace diverges at call {}: different data '
+                          'written'.format(self.index - 1))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size=1):
+        return self._next(b'R').data[:size]
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def replay(records, run, **kwargs):
+    # run(fpga) on a TinyFPGAB talking to the trace, sleeping on a virtual
+    # clock; returns the host CPU and wall seconds it took.  keyword
+    # arguments are passed on to TinyFPGAB.
+    from tinyfpgab import FlashTiming, TinyFPGAB
+    from tinyfpgab.sim import VirtualClock
+
+    clock = VirtualClock()
+    ser = TraceReplay(records)
+    fpga = TinyFPGAB(ser, timing=FlashTiming(sleep=clock.sleep,
+                                             timer=clock.time), **kwargs)
+    started, cpu = timeit.default_timer(), _cpu_timer()
+    run(fpga)
+    if ser.index != len(ser.records):
+        raise IOError('Trace has {} more calls than replayed'.format(
+            len(ser.records) - ser.index))
+    return _cpu_timer() - cpu, timeit.default_timer() - started
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="report where the time of a serial trace (recorded "
+                    "with tinyfpgab --trace) went, or replay it")
+    parser.add_argument("trace", type=str)
+    parser.add_argument("-p", "--program", type=str,
+                        help="replay programming this bitstream (with "
+                             "--addr, --diff, --pipelined and the transfer "
+                             "settings used when recording) and report the "
+                             "host time the library needs for it")
+    parser.add_argument("-a", "--addr", type=lambda text: int(text, 0))
+    parser.add_argument("--base", type=str,
+                        help="base bitstream of a .delta file")
+    parser.add_argument("--force", action="store_true",
+                        help="keep the padding of the bitstream, as "
+                             "tinyfpgab --force does")
+    parser.add_argument("--diff", action="store_true")
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("-w", "--window", type=int, default=1)
+    parser.add_argument("--read-size", type=int, default=16)
+    parser.add_argument("--write-size", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    with open(args.trace, 'rb') as f:
+        records = list(read_trace(f))
+    result = profile(records)
+    report(result)
+    if args.program is None:
+        return 0
+
+    from tinyfpgab import TinyFPGAB, ice40
+    addr, data = TinyFPGAB(None).slurp(args.program, args.base)
+    if args.addr is not None:
+        addr = args.addr
+    if not args.force:
+        # what tinyfpgab programmed
+        try:
+            data = ice40.check(data)
+        except ValueError as e:
+            print("{}: {}".format(args.program, e))
+            return 1
+
+    def run(fpga):
+        if not fpga.is_bootloader_active():
+            raise IOError('No bootloader in the trace')
+        fpga.program_bitstream(addr, data, args.diff, args.pipelined)
+
+    try:
+        cpu, seconds = replay(records, run, window=args.window,
+                              read_size=args.read_size,
+                              write_size=args.write_size)
+    except IOError as e:
+        print("Replay failed: {}".format(e))
+        return 1
+    print("Replayed in {:.3f}s, {:.3f}s host CPU (recorded {:.3f}s host "
+          "CPU)".format(seconds, cpu, result['cpu_seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())